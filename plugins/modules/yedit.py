@@ -4,17 +4,31 @@
 # GNU General Public License v3.0+
 # (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
 
-import copy
+import contextlib
+import difflib
 import fcntl
+import functools
+import gzip
+import hashlib
+import io
+import itertools
 import json
+import lzma
 import os
+import random
 import re
 import shutil
+import string
+import tempfile
 import time  # noqa: F401
 
 from ansible.module_utils.basic import AnsibleModule
 
 import ruamel.yaml as yaml
+from ruamel.yaml import events as yaml_events
+from ruamel.yaml.comments import CommentedMap
+from ruamel.yaml.nodes import ScalarNode
+from ruamel.yaml.tag import Tag
 
 ANSIBLE_METADATA = {'metadata_version': '1.1',
                     'status': ['preview'],
@@ -97,6 +111,9 @@ options:
     - Whether to append to an array/list. When the key does not exist or is
     - null, a new array is created. When the key is of a non-list type,
     - nothing is done.
+    - When the list is the last thing in the file, the top level json array
+    - or a yaml block sequence at the end, only the new item is written to the
+    - file and the result only lists the key.
     required: false
     default: false
     aliases: []
@@ -106,6 +123,7 @@ options:
     - Whether to insert to an array/list. When the key does not exist or is
     - null, a new array is created. When the key is of a non-list type,
     - nothing is done.
+    - Nothing is inserted when the value already sits at the given index.
     required: false
     default: false
     aliases: []
@@ -138,7 +156,8 @@ options:
   backup:
     description:
     - Whether to make a backup copy of the current file when performing an
-    - edit.
+    - edit.  The copy is a reflink where the file system supports it, the
+    - debug output shows how it was made and how long it took.
     required: false
     default: false
     aliases: []
@@ -149,6 +168,145 @@ options:
     required: false
     default: '.'
     aliases: []
+  sparse:
+    description:
+    - Only parse the top level keys of the file that the edits actually touch.
+    - The other keys are written back exactly as they were read.  Only applies
+    - to yaml files whose top level is a block mapping without anchors or
+    - aliases, any other file is loaded as a whole.
+    - The returned result only holds the top level keys that were read or edited.
+    required: false
+    default: false
+    aliases: []
+    type: bool
+  engine:
+    description:
+    - How edits are applied to src.  C(memory) loads the whole document.
+    - C(stream) passes the parse events of the file through to the new file,
+    - editing the matching paths on the way, so memory use does not grow with
+    - the size of the file.  It supports put, append, update with a dict and
+    - removing a key, for yaml files with a single document.
+    - The result then only lists the keys that were changed.
+    required: false
+    default: memory
+    choices: ["memory", "stream"]
+    aliases: []
+  document:
+    description:
+    - The document to work on in a yaml file holding several C(---) separated
+    - documents.  Either its index, starting at 0 and leaving out empty
+    - documents, or a selector like C(kind=Deployment,metadata.name=api) that
+    - exactly one document has to match.
+    - Only that document is parsed, the others are written back as they are.
+    required: false
+    default: None
+    aliases: []
+  durability:
+    description:
+    - How far a write makes sure the file reached the disk.  C(full) syncs the
+    - file and its directory, C(data-only) only the file data and C(none)
+    - leaves it to the operating system, which is fine on tmpfs or in image
+    - builds.  The debug output shows the mode and the time spent syncing.
+    required: false
+    default: full
+    choices: ["full", "data-only", "none"]
+    aliases: []
+  lock:
+    description:
+    - Lock src from reading it to writing it, so parallel tasks editing the
+    - same file do not lose each other's changes.  The lock is taken on the
+    - file src.yedit.lock, which is created when needed and left in place.
+    - C(list) takes a shared lock, the other states an exclusive one.  The
+    - debug output shows the time spent waiting for it.
+    required: false
+    default: false
+    aliases: []
+    type: bool
+  lock_timeout:
+    description:
+    - How many seconds to wait for the lock before failing.
+    required: false
+    default: 30
+    aliases: []
+  backup_store:
+    description:
+    - Directory to keep the backups made with I(backup) in, instead of next to
+    - the file.  Backups are stored compressed and by the hash of their
+    - contents, so identical backups take up space once.
+    required: false
+    default: None
+    aliases: []
+  backup_compression:
+    description:
+    - Compression of the backups in I(backup_store).
+    required: false
+    default: gzip
+    choices: ["gzip", "lzma"]
+    aliases: []
+  backup_keep:
+    description:
+    - How many backups of the file to keep in I(backup_store).
+    required: false
+    default: None
+    aliases: []
+  backup_max_age:
+    description:
+    - How many days to keep backups of the file in I(backup_store).
+    required: false
+    default: None
+    aliases: []
+  backup_max_bytes:
+    description:
+    - How many bytes the stored backups of the file may take up in
+    - I(backup_store).  The most recent backup is always kept.
+    required: false
+    default: None
+    aliases: []
+  backup_delta:
+    description:
+    - Only keep the most recent backup in I(backup_store) in full, and the
+    - older ones as reverse line diffs.  Meant for large files getting small
+    - edits.
+    required: false
+    default: false
+    aliases: []
+    type: bool
+  backup_restore:
+    description:
+    - Instead of editing src, put back the backup at this position in the
+    - backups of src in I(backup_store).  C(0) is the oldest backup, C(-1)
+    - the most recent one.
+    required: false
+    default: None
+    aliases: []
+  optimistic:
+    description:
+    - Instead of locking, check right before src is replaced that nobody
+    - changed it since it was read.  When it was changed, it is read again
+    - and the edits are applied again, up to I(optimistic_retries) times with
+    - a growing delay in between.
+    required: false
+    default: false
+    aliases: []
+    type: bool
+  optimistic_retries:
+    description:
+    - How many times to retry the edits when src changed underneath them.
+    required: false
+    default: 3
+    aliases: []
+  fingerprint:
+    description:
+    - Remember in an extended attribute of src, or in src.yedit.fingerprint,
+    - which edits did not change the file.  When the same edits are given
+    - again and the contents of the file are still the same, the file is
+    - only hashed instead of parsed, and the result is empty.
+    - Only used for the present state with a key and value or edits, that
+    - do not append.
+    required: false
+    default: false
+    aliases: []
+    type: bool
 author:
 - "Kenny Woodson <kwoodson@redhat.com>"
 extends_documentation_fragment: []
@@ -196,6 +354,14 @@ EXAMPLES = '''
 
 
 default_yaml = yaml.YAML()
+# Loader for documents that are only read.  It builds plain dicts and lists
+# instead of the comment preserving round-trip tree, and uses libyaml when
+# ruamel.yaml.clib is installed, falling back to pure Python otherwise.
+safe_yaml = yaml.YAML(typ='safe')
+
+
+# marks an entry that does not exist, as opposed to one holding None
+_MISSING = object()
 
 
 class YeditException(Exception):
@@ -203,12 +369,722 @@ class YeditException(Exception):
     pass
 
 
+class YeditConflict(YeditException):
+    ''' The file changed on disk since it was read '''
+    pass
+
+
+class YeditUndoLog:
+    ''' Apply mutations to a document while recording how to revert them.
+
+        Rolling back replays the inverse operations, so a failed edit can be
+        undone without ever copying the document.
+    '''
+    __slots__ = ('entries',)
+
+    def __init__(self):
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def record(self, func, *args):
+        ''' record an arbitrary inverse operation '''
+        self.entries.append((func, args))
+
+    def set_item(self, container, key, value):
+        ''' container[key] = value, appending when key is one past the end of a list '''
+        if isinstance(container, list):
+            if key == len(container):
+                container.append(value)
+                self.record(container.pop)
+                return
+
+            self.record(container.__setitem__, key, container[key])
+        elif key in container:
+            self.record(container.__setitem__, key, container[key])
+        else:
+            self.record(container.__delitem__, key)
+
+        container[key] = value
+
+    def del_item(self, container, key):
+        ''' del container[key] '''
+        if isinstance(container, list):
+            key = range(len(container))[key]
+            self.record(container.insert, key, container[key])
+        else:
+            # a missing key raises KeyError, like del container[key]
+            value = container[key]
+            self.record(YeditUndoLog._reinsert, container, list(container).index(key), key, value)
+
+        del container[key]
+
+    def insert(self, container, index, value):
+        ''' container.insert(index, value) for a list '''
+        position = min(index if index >= 0 else max(len(container) + index, 0), len(container))
+        container.insert(index, value)
+        self.record(container.__delitem__, position)
+
+    def clear(self, container):
+        ''' empty a list or a dict '''
+        if isinstance(container, list):
+            self.record(container.extend, container[:])
+        else:
+            self.record(container.update, list(container.items()))
+
+        container.clear()
+
+    @staticmethod
+    def _reinsert(container, position, key, value):
+        ''' put a removed dict key back at its original position '''
+        if hasattr(container, 'insert'):
+            container.insert(position, key, value)
+            return
+
+        tail = [(tail_key, container.pop(tail_key)) for tail_key in list(container)[position:]]
+        container[key] = value
+        container.update(tail)
+
+    def rollback(self, mark=0):
+        ''' revert every operation recorded after mark, newest first '''
+        while len(self.entries) > mark:
+            func, args = self.entries.pop()
+            func(*args)
+
+
+class YeditPath:
+    ''' A key compiled once so it can be reused across Yedit calls '''
+    __slots__ = ('key', 'separator', 'tokens')
+
+    def __init__(self, key, separator='.'):
+        tokens = Yedit.compile_key(key, separator)
+        if tokens is None:
+            raise YeditException('Invalid key: {0}'.format(key))
+
+        self.key = key
+        self.separator = separator
+        self.tokens = tokens
+
+    def __str__(self):
+        return self.key
+
+    def __repr__(self):
+        return 'YeditPath({0!r}, {1!r})'.format(self.key, self.separator)
+
+    def __eq__(self, other):
+        if isinstance(other, YeditPath):
+            return self.tokens == other.tokens
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.tokens)
+
+
+class YeditStreamEditor:
+    ''' Apply edits to a yaml document while it is being parsed.
+
+        The parse events of the source go straight to the emitter and only the
+        nodes at the edited paths are looked at, so memory use is bounded by
+        the nesting depth and the size of those nodes instead of the size of
+        the document.  Supports put, delete, append and update with a dict,
+        using the same keys as Yedit.
+    '''
+    __slots__ = ('root', 'changed')
+
+    def __init__(self):
+        self.root = YeditStreamEditor._trie()
+        self.changed = set()
+
+    @staticmethod
+    def _trie():
+        ''' a node of the tree of edited paths '''
+        return {'ops': [], 'children': {}}
+
+    @classmethod
+    def from_edits(cls, edits, separator='.'):
+        ''' build an editor from the edits accepted by Yedit.process_edits, plus the delete action '''
+        editor = cls()
+        for index, edit in enumerate(edits):
+            tokens = Yedit.key_tokens(edit['key'], separator)
+            if not tokens:
+                raise YeditException('The stream engine cannot edit key [{0}].'.format(edit['key']))
+
+            action = edit.get('action')
+            if action == 'delete':
+                editor.add('delete', tokens, index=index)
+                continue
+
+            value = Yedit.parse_value(edit['value'], edit.get('value_type', ''))
+            if action == 'update':
+                if not isinstance(value, dict) or edit.get('index') is not None or edit.get('curr_value'):
+                    raise YeditException('The stream engine can only update a dict with a dict.')
+                for key in value:
+                    if not isinstance(key, str):
+                        raise YeditException('The stream engine cannot update the key [{0}].'.format(key))
+                editor.add('update', tokens, value, index)
+
+            elif action == 'append':
+                editor.add('append', tokens, value, index)
+
+            elif action == 'insert':
+                raise YeditException('The stream engine does not support insert.')
+
+            else:
+                editor.add('put', tokens, value, index)
+
+        return editor
+
+    def add(self, action, tokens, value=None, index=None):
+        ''' register an edit of the node at tokens, index identifies the edit in changed '''
+        trie = self.root
+        for token in tokens:
+            if trie['ops']:
+                raise YeditException('The stream engine cannot apply edits to nested paths.')
+            if isinstance(token, int) and token < 0:
+                raise YeditException('The stream engine does not support negative indexes.')
+            trie = trie['children'].setdefault(token, YeditStreamEditor._trie())
+
+        # only appends, or updates, can be stacked on the same path
+        if trie['children'] or any(op[0] != action or action not in ('append', 'update') for op in trie['ops']):
+            raise YeditException('The stream engine cannot apply edits to nested paths.')
+        trie['ops'].append((action, value, index))
+
+    def run(self, source, target):
+        ''' copy the yaml document in source to target with the edits applied.
+
+            Returns whether any edit changed the document, the indexes of those
+            edits are in changed.
+        '''
+        self.changed = set()
+        events = yaml.YAML().parse(source)
+        try:
+            yaml.YAML().emit(Yedit._stream_emittable(self._document(events)), target)
+        finally:
+            events.close()
+
+        return bool(self.changed)
+
+    def _document(self, events):
+        ''' the events of the edited document '''
+        for event in events:
+            yield event
+            if isinstance(event, yaml_events.DocumentStartEvent):
+                break
+        else:
+            raise YeditException('The stream engine cannot edit an empty file.')
+
+        yield from self._entry(events, next(events), self.root)
+
+        for event in events:
+            if isinstance(event, yaml_events.DocumentStartEvent):
+                raise YeditException('The stream engine only edits files with a single document.')
+            yield event
+
+    @staticmethod
+    def _resolves_to(event, tag):
+        ''' whether a scalar event is a plain scalar of type tag, or a quoted one for strings '''
+        if not isinstance(event, yaml_events.ScalarEvent) or event.tag is not None:
+            return False
+        if not event.implicit[0]:
+            return tag == 'tag:yaml.org,2002:str'
+        return safe_yaml.resolver.resolve(ScalarNode, event.value, (True, False)) == tag
+
+    def _entry(self, events, event, trie):
+        ''' pass on the existing node that starts with event, applying the edits in trie '''
+        if isinstance(event, yaml_events.AliasEvent):
+            raise YeditException('The stream engine cannot edit through an alias.')
+
+        ops = trie['ops']
+        if not ops:
+            if isinstance(event, yaml_events.MappingStartEvent):
+                yield from self._mapping(events, event, trie)
+            elif isinstance(event, yaml_events.SequenceStartEvent):
+                yield from self._sequence(events, event, trie)
+            elif YeditStreamEditor._resolves_to(event, 'tag:yaml.org,2002:null'):
+                yield from self._created(trie, event)
+            else:
+                raise YeditException('The stream engine cannot add keys below a {0}.'.format(event.value))
+
+        elif ops[0][0] == 'append':
+            if isinstance(event, yaml_events.SequenceStartEvent):
+                yield event
+                item = next(events)
+                while not isinstance(item, yaml_events.SequenceEndEvent):
+                    yield item
+                    yield from Yedit._stream_copy(events, item)
+                    item = next(events)
+                for _, value, index in ops:
+                    yield from YeditStreamEditor._value_events(value)
+                    self.changed.add(index)
+                yield item
+            elif YeditStreamEditor._resolves_to(event, 'tag:yaml.org,2002:null'):
+                yield from self._created(trie, event)
+            else:
+                # like Yedit.append, nothing is appended to something that is not a list
+                yield event
+                yield from Yedit._stream_copy(events, event)
+
+        elif ops[0][0] == 'update':
+            if isinstance(event, yaml_events.MappingStartEvent):
+                yield from self._mapping(events, event, YeditStreamEditor._update_trie(ops))
+            elif isinstance(event, yaml_events.SequenceStartEvent):
+                raise YeditException('The stream engine cannot update a list.')
+            else:
+                # like Yedit.update, nothing is updated below something that is not a dict
+                yield event
+                yield from Yedit._stream_copy(events, event)
+
+        else:
+            node_events = [event] + list(Yedit._stream_copy(events, event))
+            found, current = Yedit._stream_value(node_events)
+            if found and current == ops[0][1]:
+                yield from node_events
+            else:
+                yield from self._created(trie, event)
+
+    def _mapping(self, events, event, trie):
+        ''' pass on a mapping, descending into the edited keys '''
+        yield event
+        seen = set()
+        while True:
+            key = next(events)
+            if isinstance(key, yaml_events.MappingEndEvent):
+                break
+
+            child = None
+            if YeditStreamEditor._resolves_to(key, 'tag:yaml.org,2002:str'):
+                child = trie['children'].get(key.value)
+                seen.add(key.value)
+
+            if child is None:
+                yield key
+                yield from Yedit._stream_copy(events, key)
+                value = next(events)
+                yield value
+                yield from Yedit._stream_copy(events, value)
+            elif child['ops'] and child['ops'][0][0] == 'delete':
+                Yedit._stream_skip(events, next(events))
+                self.changed.add(child['ops'][0][2])
+            else:
+                yield key
+                yield from self._entry(events, next(events), child)
+
+        for token, child in trie['children'].items():
+            if token in seen or not YeditStreamEditor._creates(child):
+                continue
+            if not isinstance(token, str):
+                raise YeditException('The stream engine cannot add index [{0}] to a dict.'.format(token))
+
+            value = self._build(child)
+            if value is not _MISSING:
+                yield from YeditStreamEditor._value_events(token)
+                yield from YeditStreamEditor._value_events(value)
+        yield key
+
+    def _sequence(self, events, event, trie):
+        ''' pass on a sequence, descending into the edited items '''
+        yield event
+        position = 0
+        while True:
+            item = next(events)
+            if isinstance(item, yaml_events.SequenceEndEvent):
+                break
+
+            child = trie['children'].get(position)
+            if child is None:
+                yield item
+                yield from Yedit._stream_copy(events, item)
+            elif child['ops'] and child['ops'][0][0] == 'delete':
+                Yedit._stream_skip(events, item)
+                self.changed.add(child['ops'][0][2])
+            else:
+                yield from self._entry(events, item, child)
+            position += 1
+
+        # like Yedit.update and Yedit.delete, missing paths that are only updated or deleted are left alone
+        created = dict((token, child) for token, child in trie['children'].items()
+                       if YeditStreamEditor._creates(child) and (isinstance(token, str) or token >= position))
+        if any(isinstance(token, str) for token in created):
+            raise YeditException('The stream engine cannot add keys to a list.')
+
+        for token in sorted(created):
+            if token != position:
+                raise YeditException('The stream engine can only add an item at the end of a list.')
+
+            value = self._build(created[token])
+            if value is not _MISSING:
+                yield from YeditStreamEditor._value_events(value)
+                position += 1
+        yield item
+
+    @staticmethod
+    def _creates(trie):
+        ''' whether the edits in trie make a node where there is none, updates and deletes do not '''
+        return any(op[0] in ('put', 'append') for op in trie['ops']) or \
+            any(YeditStreamEditor._creates(child) for child in trie['children'].values())
+
+    @staticmethod
+    def _update_trie(ops):
+        ''' the edits of the updates in ops as puts of the keys of an existing mapping '''
+        trie = YeditStreamEditor._trie()
+        for _, value, index in ops:
+            for key, val in value.items():
+                trie['children'][key] = {'ops': [('put', val, index)], 'children': {}}
+        return trie
+
+    def _created(self, trie, replaced):
+        ''' the events of the node built from the edits in trie, in place of the node replaced '''
+        value = self._build(trie)
+        if value is _MISSING:
+            return [replaced]
+
+        new_events = YeditStreamEditor._value_events(value)
+        # keep the comment on the line of a replaced scalar
+        if isinstance(replaced, yaml_events.ScalarEvent) and isinstance(new_events[0], yaml_events.ScalarEvent):
+            new_events[0].comment = replaced.comment
+        return new_events
+
+    def _build(self, trie):
+        ''' the value for a node that only exists through the edits in trie, or _MISSING '''
+        ops = trie['ops']
+        if ops:
+            # an update does not create the mapping it updates
+            if ops[0][0] in ('delete', 'update'):
+                return _MISSING
+
+            self.changed.update(op[2] for op in ops)
+            if ops[0][0] == 'append':
+                return [op[1] for op in ops]
+            return ops[0][1]
+
+        value = {}
+        for token, child in trie['children'].items():
+            if not YeditStreamEditor._creates(child):
+                continue
+            if not isinstance(token, str):
+                raise YeditException('Error adding to object at path: [{0}]'.format(token))
+            item = self._build(child)
+            if item is not _MISSING:
+                value[token] = item
+
+        return value if value else _MISSING
+
+    @staticmethod
+    def _value_events(value):
+        ''' the parse events of a value '''
+        text = io.StringIO()
+        default_yaml.dump(value, text)
+        # strip the stream and document events
+        return list(default_yaml.parse(text.getvalue()))[2:-2]
+
+
+class YeditBackupStore:
+    ''' Keeps the backups of files by the hash of their contents.
+
+        The contents are compressed and stored once under objects/, and every
+        backed up file has an index of its backups under index/.  Backups
+        beyond the retention limits are dropped from the index, and contents
+        no index refers to anymore are deleted.  Which indexes refer to an
+        object is kept under refs/, so a backup only looks at the objects its
+        own index stops referring to.
+
+        With delta only the newest backup of a file is stored in full, every
+        older one is a reverse line diff that turns the backup after it back
+        into the older one.
+    '''
+    compressions = {'gzip': (gzip.open, '.gz'), 'lzma': (lzma.open, '.xz')}
+    # objects younger than this are not collected, they may belong to a backup being made
+    gc_grace = 60
+
+    def __init__(self, path, compression='gzip', max_count=None, max_age=None, max_bytes=None, delta=False):
+        if compression not in YeditBackupStore.compressions:
+            raise YeditException('Invalid backup compression: {0}'.format(compression))
+
+        self.path = path
+        self.compression = compression
+        self.delta = delta
+        self.max_count = max_count
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def _index_key(filename):
+        ''' the name of the index of the backups of filename '''
+        return hashlib.sha256(os.path.realpath(filename).encode('utf-8')).hexdigest()
+
+    def _index_path(self, filename):
+        ''' the index of the backups of filename '''
+        return os.path.join(self.path, 'index', YeditBackupStore._index_key(filename) + '.json')
+
+    def _refs_path(self, object_path):
+        ''' the directory with an entry for every index that refers to the object at object_path '''
+        return os.path.join(self.path, 'refs', os.path.relpath(object_path, os.path.join(self.path, 'objects')))
+
+    def _object_path(self, digest, compression):
+        ''' where contents with hash digest are stored '''
+        return os.path.join(self.path, 'objects', digest[:2], digest + YeditBackupStore.compressions[compression][1])
+
+    def _entry_path(self, entry):
+        ''' where the full contents or the diff of a backup are stored '''
+        return self._object_path(entry.get('delta', entry['hash']), entry['compression'])
+
+    def backups(self, filename):
+        ''' the backups of filename, oldest first '''
+        try:
+            with open(self._index_path(filename)) as yfd:
+                return json.load(yfd)['backups']
+        except FileNotFoundError:
+            return []
+
+    def _save_backups(self, filename, backups):
+        ''' replace the index of filename '''
+        path = self._index_path(filename)
+        if not backups:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        index = json.dumps({'path': os.path.realpath(filename), 'backups': backups}, indent=4, sort_keys=True)
+        Yedit._write(path, lambda f: f.write(index))
+
+    def add(self, filename):
+        ''' back up the current contents of filename, returning its index entry '''
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as source:
+            for chunk in iter(lambda: source.read(1 << 20), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+
+        # backups of the same file are serialized, so none of them is lost from the index
+        index_path = self._index_path(filename)
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        lock_fd = Yedit._lock(index_path)
+        try:
+            backups = self.backups(filename)
+            if backups and backups[-1]['hash'] == digest:
+                return backups[-1]
+
+            before = set(self._entry_path(entry) for entry in backups)
+            object_path = self._object_path(digest, self.compression)
+            self._store(object_path, lambda: open(filename, 'rb'))
+
+            entry = {'hash': digest,
+                     'time': time.time(),
+                     'size': os.stat(filename).st_size,
+                     'compression': self.compression,
+                     'stored': os.stat(object_path).st_size}
+            if self.delta and backups and 'delta' not in backups[-1]:
+                with open(filename, newline='') as source:
+                    self._make_delta(backups[-1], source.read())
+            backups.append(entry)
+            backups = self.retain(backups)
+
+            after = set(self._entry_path(entry) for entry in backups)
+            key = YeditBackupStore._index_key(filename)
+            for path in after - before:
+                self._add_ref(path, key)
+            self._save_backups(filename, backups)
+            for path in before - after:
+                self._drop_ref(path, key)
+        finally:
+            Yedit._unlock(lock_fd)
+
+        return entry
+
+    def _add_ref(self, object_path, key):
+        ''' record that the index named key refers to the object at object_path '''
+        refs_path = self._refs_path(object_path)
+        while True:
+            os.makedirs(refs_path, exist_ok=True)
+            try:
+                with open(os.path.join(refs_path, key), 'w'):
+                    return
+            except FileNotFoundError:
+                # the last reference to the object was just dropped
+                continue
+
+    def _drop_ref(self, object_path, key):
+        ''' Record that the index named key no longer refers to the object at
+            object_path, and delete the object when no index does.
+
+            The directory of references is only removed when it is empty,
+            which is atomic, and objects younger than gc_grace are left for
+            collect, they may be about to get a reference.
+        '''
+        refs_path = self._refs_path(object_path)
+        try:
+            os.unlink(os.path.join(refs_path, key))
+            os.rmdir(refs_path)
+        except OSError:
+            return
+
+        try:
+            if os.stat(object_path).st_mtime < time.time() - YeditBackupStore.gc_grace:
+                os.unlink(object_path)
+        except FileNotFoundError:
+            pass
+
+    def _store(self, object_path, open_source):
+        ''' compress the binary file returned by open_source into object_path, unless it is there already '''
+        if os.path.exists(object_path):
+            # keep it from being collected while the index does not refer to it yet
+            os.utime(object_path)
+            return
+
+        directory = os.path.dirname(object_path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        try:
+            with open(fd, 'wb') as target, \
+                    YeditBackupStore.compressions[self.compression][0](target, 'wb') as compressed, \
+                    open_source() as source:
+                shutil.copyfileobj(source, compressed)
+            os.rename(tmp_path, object_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _read(self, entry):
+        ''' the text stored for a backup, its contents or its diff '''
+        with YeditBackupStore.compressions[entry['compression']][0](self._entry_path(entry), 'rt',
+                                                                    encoding='utf-8', newline='') as source:
+            return source.read()
+
+    def _make_delta(self, entry, newer):
+        ''' store the full backup entry as the diff that turns the text newer back into it '''
+        older = self._read(entry).splitlines(True)
+        newer = newer.splitlines(True)
+
+        # only the lines between the common start and end are diffed, and
+        # autojunk keeps lines repeated all over the file, like `- name: x`,
+        # from making the matcher quadratic
+        shortest = min(len(older), len(newer))
+        prefix = 0
+        while prefix < shortest and older[prefix] == newer[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < shortest - prefix and older[-1 - suffix] == newer[-1 - suffix]:
+            suffix += 1
+        older = older[prefix:len(older) - suffix]
+        newer = newer[prefix:len(newer) - suffix]
+
+        matcher = difflib.SequenceMatcher(None, newer, older)
+        patch = [[prefix + start, prefix + end, older[old_start:old_end]]
+                 for tag, start, end, old_start, old_end in matcher.get_opcodes() if tag != 'equal']
+
+        data = json.dumps(patch).encode('utf-8')
+        digest = hashlib.sha256(data).hexdigest()
+        entry['compression'] = self.compression
+        entry['delta'] = digest
+        object_path = self._entry_path(entry)
+        self._store(object_path, lambda: io.BytesIO(data))
+        entry['stored'] = os.stat(object_path).st_size
+
+    @staticmethod
+    def _apply_delta(lines, patch):
+        ''' turn the lines of a backup into those of the backup before it '''
+        for start, end, older in reversed(patch):
+            lines[start:end] = older
+        return lines
+
+    def contents(self, filename, position=-1):
+        ''' the text of the backup at position in the backups of filename '''
+        backups = self.backups(filename)
+        try:
+            position = range(len(backups))[position]
+        except IndexError:
+            raise YeditException('No backup {0} of {1}, there are {2}.'.format(position, filename, len(backups)))
+
+        # diffs lead back from the first full backup after position
+        start = position
+        while 'delta' in backups[start]:
+            start += 1
+            if start == len(backups):
+                raise YeditException('The backups of {0} have no full copy to start from.'.format(filename))
+
+        lines = self._read(backups[start]).splitlines(True)
+        for current in range(start - 1, position - 1, -1):
+            lines = YeditBackupStore._apply_delta(lines, json.loads(self._read(backups[current])))
+
+        text = ''.join(lines)
+        if hashlib.sha256(text.encode('utf-8')).hexdigest() != backups[position]['hash']:
+            raise YeditException('Backup {0} of {1} is corrupt.'.format(position, filename))
+        return text
+
+    def retain(self, backups):
+        ''' the backups to keep under the retention limits, the newest one is always kept '''
+        keep = list(backups)
+        if self.max_age is not None:
+            now = time.time()
+            keep = [entry for entry in keep if now - entry['time'] <= self.max_age]
+        if self.max_count is not None:
+            keep = keep[len(keep) - self.max_count:] if self.max_count < len(keep) else keep
+        if self.max_bytes is not None:
+            total = 0
+            for position in range(len(keep) - 1, -1, -1):
+                total += keep[position]['stored']
+                if total > self.max_bytes:
+                    keep = keep[position + 1:]
+                    break
+
+        return keep or backups[-1:]
+
+    def collect(self):
+        ''' Delete the contents no index refers to, returning how many were deleted.
+
+            add only deletes the objects the index it changes stops referring
+            to, this goes through the whole store for what that left behind.
+        '''
+        referenced = set()
+        index_dir = os.path.join(self.path, 'index')
+        for name in os.listdir(index_dir) if os.path.isdir(index_dir) else []:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(index_dir, name)) as yfd:
+                    backups = json.load(yfd)['backups']
+            except (OSError, ValueError, KeyError):
+                continue
+            referenced.update(self._entry_path(entry) for entry in backups)
+
+        removed = 0
+        cutoff = time.time() - YeditBackupStore.gc_grace
+        for directory, _, names in os.walk(os.path.join(self.path, 'objects')):
+            for name in names:
+                path = os.path.join(directory, name)
+                if path not in referenced and os.stat(path).st_mtime < cutoff:
+                    os.unlink(path)
+                    removed += 1
+
+        return removed
+
+    def restore(self, filename, position=-1, target=None):
+        ''' write the backup at position in the backups of filename to target, filename by default '''
+        contents = self.contents(filename, position)
+        Yedit._write(target or filename, lambda f: f.write(contents))
+        return self.backups(filename)[position]
+
+
 # pylint: disable=too-many-public-methods,too-many-instance-attributes
 class Yedit:
     ''' Class to modify yaml files '''
     re_valid_key = r"(((\[-?\d+\])|([0-9a-zA-Z%s/_-]+)).?)+$"
     re_key = r"(?:\[(-?\d+)\])|([0-9a-zA-Z{}/_-]+)"
     com_sep = set(['.', '#', '|', ':'])
+    key_chars = frozenset(string.ascii_letters + string.digits + '/_-')
+    re_section_line = re.compile(r"^[^\s#].*$", re.M)
+    re_section_key = re.compile(r"(?:(?P<plain>[^\s'\"#{}\[\],&*!|>%@`?:-][^\s:#]*(?:[ \t]+[^\s:#]+)*)|"
+                                r"\"(?P<dq>[^\"\\]*)\"|'(?P<sq>[^']*)')[ \t]*:(?:[ \t]|$)")
+    re_document_start = re.compile(r"---[ \t]*(#.*)?\r?$")
+    re_document_marker = re.compile(r"^(---|\.\.\.)(?=[ \t\r\n]|$).*$", re.M)
+    # directives, like `%YAML 1.2`, are not document content
+    re_content_line = re.compile(r"^[ \t]*[^\s#%]", re.M)
+    re_root_item = re.compile(r"^-(?:[ \t]|$)", re.M)
+    re_root_other = re.compile(r"^(?!-(?:[ \t]|$))[^\s#]", re.M)
 
     # pylint: disable=too-many-arguments
     def __init__(self,
@@ -217,7 +1093,14 @@ class Yedit:
                  content_type='yaml',
                  separator='.',
                  backup_ext=".{0}".format(time.strftime("%Y%m%dT%H%M%S")),
-                 backup=False):
+                 backup=False,
+                 read_only=False,
+                 splice=False,
+                 sparse=False,
+                 document=None,
+                 durability='full',
+                 backup_store=None,
+                 optimistic=False):
         self.content = content
         self._separator = separator
         self.filename = filename
@@ -225,9 +1108,38 @@ class Yedit:
         self.content_type = content_type
         self.backup = backup
         self.backup_ext = backup_ext
-        self.load(content_type=self.content_type)
-        if self.__yaml_dict is None:
-            self.__yaml_dict = {}
+        # a YeditBackupStore to keep backups in, instead of copies next to the file
+        self.backup_store = backup_store
+        self.read_only = read_only
+        # Only rewrite the text of changed scalars on write.  This relies on
+        # every change going through the Yedit methods, direct changes to
+        # yaml_dict are not tracked.
+        self.splice = splice
+        # Only parse the top level sections that are accessed, see split_sections.
+        self.sparse = sparse
+        self._sections = None
+        self._section_index = None
+        # Edit a single document of a multi document file, by index or selector.
+        # The text around it is kept in _head and _tail and written back as is.
+        self.document = document
+        self._head = ''
+        self._tail = ''
+        if durability not in Yedit.durability_modes:
+            raise YeditException('Invalid durability: {0}'.format(durability))
+        self.durability = durability
+        # timings and choices made along the way, returned by the module in debug mode
+        self.debug_info = {'durability': durability}
+        self._lock_fd = None
+        # Refuse to replace the file when it changed since it was read, see _unchanged.
+        self.optimistic = optimistic
+        self._read_stamp = None
+        self._splices = {}
+        self._structural = True
+        self._undo_log = None
+        self._source = None
+        self._loaded = None
+        # the document is only read and parsed on first access, see yaml_dict
+        self._lazy = True
 
     @property
     def separator(self):
@@ -241,34 +1153,436 @@ class Yedit:
 
     @property
     def yaml_dict(self):
-        ''' getter method for yaml_dict '''
+        ''' getter method for yaml_dict, loading the document on first access '''
+        if self._lazy:
+            self._materialize()
+        if self._sections is not None:
+            self._expand_all()
         return self.__yaml_dict
 
     @yaml_dict.setter
     def yaml_dict(self, value):
         ''' setter method for yaml_dict '''
+        self._lazy = False
+        self._structural = True
+        self._sections = None
         self.__yaml_dict = value
 
+    @property
+    def _doc(self):
+        ''' the document as the edit methods see it.
+
+            Unlike yaml_dict this does not parse every section of a sparse
+            document, only those that were expanded so far.
+        '''
+        if self._lazy:
+            self._materialize()
+        return self.__yaml_dict
+
+    @staticmethod
+    def split_sections(text):
+        ''' Split a yaml document into its top level mapping sections.
+
+            Every line starting in the first column, other than comments and
+            sequence items, starts a section and has to be a simple `key:` line.  Returns a
+            list of (key, text) tuples, the first one carrying any leading
+            comments, or None when the document does not have that shape or
+            uses anchors, aliases or merge keys, which can tie sections together.
+        '''
+        if text.startswith('\ufeff') or re.search(r'(^|\s)[&*]\S|<<', text):
+            return None
+
+        str_tag = 'tag:yaml.org,2002:str'
+        sections = []
+        starts = []
+        for match in Yedit.re_section_line.finditer(text):
+            line = match.group(0)
+            if not sections and not starts and Yedit.re_document_start.match(line):
+                continue
+            # a block sequence in the first column is the value of the key before it
+            if sections and Yedit.re_root_item.match(line):
+                continue
+
+            key_match = Yedit.re_section_key.match(line)
+            if key_match is None:
+                return None
+
+            key = key_match.group('plain')
+            if key is not None:
+                if safe_yaml.resolver.resolve(ScalarNode, key, (True, False)) != str_tag:
+                    return None
+            else:
+                key = key_match.group('dq') if key_match.group('dq') is not None else key_match.group('sq')
+
+            if key in sections:
+                return None
+            sections.append(key)
+            starts.append(match.start())
+
+        if not sections:
+            return None
+
+        starts[0] = 0
+        ends = starts[1:] + [len(text)]
+        return [(key, text[start:end]) for key, start, end in zip(sections, starts, ends)]
+
+    @staticmethod
+    def split_documents(text):
+        ''' Return the (start, end) offsets of the documents in a yaml stream.
+
+            Documents are separated by `---` and `...` lines.  The markers are
+            not part of a document, when a document starts on its `---` line,
+            like `--- {a: 1}`, it starts right after the `---`.  Documents without
+            any content, and the directives before a document, are left out.
+        '''
+        documents = []
+        start = 0
+        inline = False
+        for marker in Yedit.re_document_marker.finditer(text):
+            if start is not None and (inline or Yedit.re_content_line.search(text, start, marker.start())):
+                documents.append((start, marker.start()))
+
+            inline = False
+            if marker.group(1) == '...':
+                start = None
+            elif Yedit.re_document_start.match(marker.group(0)):
+                start = min(marker.end() + 1, len(text))
+            else:
+                # content on the marker line, like `--- |` or `--- !tag`
+                start = marker.start() + 3
+                inline = True
+
+        if start is not None and (inline or Yedit.re_content_line.search(text, start)):
+            documents.append((start, len(text)))
+
+        return documents
+
+    def select_document(self, text):
+        ''' Cut the document picked by self.document out of text.
+
+            document is an index, or a selector like `kind=Deployment,metadata.name=api`
+            that exactly one document has to match.  Only the keys of the
+            selector are read from each document.  The text before and after
+            the document is kept for write.
+        '''
+        documents = Yedit.split_documents(text)
+        selector = str(self.document)
+        if re.match(r'-?\d+$', selector):
+            try:
+                start, end = documents[int(selector)]
+            except IndexError:
+                raise YeditException('Document {0} not found in {1}, it has {2} documents.'.format(
+                    selector, self.filename, len(documents)))
+        else:
+            matches = [doc for doc in documents if Yedit.match_document(text[doc[0]:doc[1]], selector, self.separator)]
+            if len(matches) != 1:
+                raise YeditException('Selector {0} matches {1} documents in {2}, expected one.'.format(
+                    selector, len(matches), self.filename))
+            start, end = matches[0]
+
+        self._head = text[:start]
+        self._tail = text[end:]
+        self._source = text[start:end]
+        return self._source
+
+    @staticmethod
+    def match_document(text, selector, separator='.'):
+        ''' whether the document in text has every key=value pair of a selector '''
+        for pair in selector.split(','):
+            key, _, expected = pair.partition('=')
+            tokens = Yedit.key_tokens(key.strip(), separator)
+            if not tokens:
+                raise YeditException('Invalid selector: {0}'.format(selector))
+
+            found, value = Yedit.stream_get(io.StringIO(text), tokens)
+            if not found:
+                try:
+                    value = Yedit.get_entry(safe_yaml.load(text), tokens, separator)
+                except (yaml.YAMLError, KeyError):
+                    value = None
+
+            expected = expected.strip()
+            if value is None or (str(value) != expected and value != safe_yaml.load(expected)):
+                return False
+
+        return True
+
+    def _start_sparse(self, sections):
+        ''' keep the sections of a document unparsed until they are accessed '''
+        self.yaml_dict = CommentedMap()
+        self._sections = [{'key': key, 'text': text, 'map': None, 'dirty': False} for key, text in sections]
+        self._section_index = dict((section['key'], section) for section in self._sections)
+
+    @staticmethod
+    def _parse_section(section):
+        ''' parse the text of a single section '''
+        try:
+            section_map = default_yaml.load(section['text'])
+        except yaml.YAMLError as err:
+            raise YeditException(f'Problem with loading yaml file. {err}')
+
+        if not isinstance(section_map, CommentedMap) or list(section_map) != [section['key']]:
+            raise YeditException('Problem with loading yaml file. ' +
+                                 'Unexpected content in section {0}.'.format(section['key']))
+        section['map'] = section_map
+
+    def _expand(self, path, dirty=False):
+        ''' parse the top level section that path descends into, when the document is sparse '''
+        if self._lazy:
+            self._materialize()
+        if self._sections is None:
+            return
+
+        tokens = Yedit.key_tokens(path, self.separator)
+        if tokens == ():
+            self._expand_all()
+            return
+        if not tokens:
+            return
+
+        section = self._section_index.get(tokens[0])
+        if section is None:
+            return
+
+        if section['map'] is None:
+            Yedit._parse_section(section)
+            self.__yaml_dict[section['key']] = section['map'][section['key']]
+        if dirty:
+            section['dirty'] = True
+
+    def _expand_all(self):
+        ''' parse every section and leave sparse mode '''
+        partial = self.__yaml_dict
+        root = CommentedMap()
+        for section in self._sections:
+            key = section['key']
+            if section['map'] is None:
+                Yedit._parse_section(section)
+                root[key] = section['map'][key]
+            elif key in partial:
+                root[key] = partial[key]
+            else:
+                # removed since it was expanded
+                continue
+
+            if section['map'].ca.comment and not root.ca.comment:
+                root.ca.comment = section['map'].ca.comment
+            if key in section['map'].ca.items:
+                root.ca.items[key] = section['map'].ca.items[key]
+
+        for key, value in partial.items():
+            if key not in self._section_index:
+                root[key] = value
+
+        self.yaml_dict = root
+
+    @staticmethod
+    def _section_key_start(text):
+        ''' the offset of the key line of a section, after any leading comments '''
+        for match in Yedit.re_section_line.finditer(text):
+            if not Yedit.re_document_start.match(match.group(0)):
+                return match.start()
+        return len(text)
+
+    def _sparse_dumps(self):
+        ''' write unparsed and unchanged sections back verbatim, and dump the others '''
+        partial = self.__yaml_dict
+        parts = []
+        for section in self._sections:
+            key = section['key']
+            if not section['dirty']:
+                parts.append(section['text'])
+            elif key in partial:
+                section['map'][key] = partial[key]
+                stream = io.StringIO()
+                default_yaml.dump(section['map'], stream)
+                parts.append(stream.getvalue())
+            elif section is self._sections[0]:
+                # the comments leading the file belong to it, not to its first key
+                parts.append(section['text'][:Yedit._section_key_start(section['text'])])
+
+        added = CommentedMap((key, value) for key, value in partial.items() if key not in self._section_index)
+        if added:
+            if parts and not parts[-1].endswith('\n'):
+                parts.append('\n')
+            stream = io.StringIO()
+            default_yaml.dump(added, stream)
+            parts.append(stream.getvalue())
+
+        return ''.join(parts)
+
+    def _materialize(self, content_type=None):
+        ''' perform the initial load that the constructor deferred '''
+        self._lazy = False
+        rval = self.load(content_type=content_type)
+        if self.__yaml_dict is None:
+            self.__yaml_dict = {}
+
+        return rval
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _key_patterns(sep='.'):
+        '''compile the validation and tokenization patterns for a separator'''
+        common_separators = ''.join(sorted(Yedit.com_sep - set([sep])))
+        return (re.compile(Yedit.re_valid_key.format(common_separators)),
+                re.compile(Yedit.re_key.format(common_separators)))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _key_charset(sep='.'):
+        '''characters allowed in a dict key segment for a separator'''
+        return Yedit.key_chars | (Yedit.com_sep - set([sep]))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def compile_key(key, sep='.'):
+        '''validate and tokenize the key in a single pass.
+
+           Returns a tuple of segments, ints for array indexes and strs for
+           dict keys, an empty tuple for the top of the document or None when
+           the key is not valid.  Segments may be separated by at most one
+           character.  Results are memoized, see compile_key.cache_info() for
+           the hit/miss counters.
+        '''
+        if key == '':
+            return ()
+
+        if not key or not isinstance(key, str):
+            return None
+
+        key_charset = Yedit._key_charset(sep)
+        tokens = []
+        gap_allowed = False
+        pos = 0
+        end = len(key)
+        while pos < end:
+            char = key[pos]
+            if char == '[':
+                close = key.find(']', pos + 1)
+                digits = key[pos + 1:close] if close > 0 else ''
+                if digits[:1] == '-':
+                    digits_only = digits[1:]
+                else:
+                    digits_only = digits
+                if digits_only.isdecimal():
+                    tokens.append(int(digits))
+                    gap_allowed = True
+                    pos = close + 1
+                    continue
+
+            if char in key_charset:
+                start = pos
+                pos += 1
+                while pos < end and key[pos] in key_charset:
+                    pos += 1
+                tokens.append(key[start:pos])
+                gap_allowed = True
+                continue
+
+            # anything else is a separator, which must follow a segment
+            if not gap_allowed:
+                return None
+            gap_allowed = False
+            pos += 1
+
+        return tuple(tokens)
+
+    @staticmethod
+    def key_tokens(key, sep='.'):
+        '''return the compiled tokens for a string key, a YeditPath or a tuple of tokens'''
+        if isinstance(key, YeditPath):
+            return key.tokens
+
+        if isinstance(key, tuple):
+            return key
+
+        return Yedit.compile_key(key, sep)
+
     @staticmethod
     def parse_key(key, sep='.'):
         '''parse the key allowing the appropriate separator'''
-        common_separators = list(Yedit.com_sep - set([sep]))
-        return re.findall(Yedit.re_key.format(''.join(common_separators)), key)
+        return Yedit._key_patterns(sep)[1].findall(key)
 
     @staticmethod
     def valid_key(key, sep='.'):
         '''validate the incoming key'''
-        common_separators = list(Yedit.com_sep - set([sep]))
-        if not re.match(Yedit.re_valid_key.format(''.join(common_separators)), key):
+        if not Yedit._key_patterns(sep)[0].match(key):
             return False
 
         return True
 
+    @staticmethod
+    def cursor(data, tokens, create=False, key=None, undo=None):
+        ''' Walk all but the last token and return a (parent, token) cursor.
+
+            The parent is the container holding the final token, so a single
+            walk is enough to read, set or remove the entry.  Returns None when
+            the parent cannot be reached.  With create, missing or empty dict
+            entries along the way are replaced with new dicts, recorded in the
+            undo log when one is given, and a YeditException is raised when the
+            path runs into another type.
+        '''
+        for token in tokens[:-1]:
+            if isinstance(token, str):
+                if isinstance(data, dict) and token in data and (data[token] or not create):
+                    data = data[token]
+                    continue
+
+                elif not create:
+                    return None
+
+                elif data and not isinstance(data, dict):
+                    raise YeditException("Unexpected item type found while going through key " +
+                                         "path: {0} (at key: {1})".format(key, token))
+
+                if undo is not None:
+                    undo.set_item(data, token, {})
+                else:
+                    data[token] = {}
+                data = data[token]
+
+            elif isinstance(data, list) and token < len(data):
+                data = data[token]
+            elif not create:
+                return None
+            else:
+                raise YeditException("Unexpected item type found while going through key path: {0}".format(key))
+
+        return data, tokens[-1]
+
+    @staticmethod
+    def cursor_get(parent, token):
+        ''' return the entry a cursor points at or None when it does not exist '''
+        if isinstance(token, str) and isinstance(parent, dict):
+            return parent.get(token)
+        elif isinstance(token, int) and isinstance(parent, list) and token < len(parent):
+            return parent[token]
+
+        return None
+
+    @staticmethod
+    def cursor_settable(parent, token):
+        ''' whether an item can be stored at a cursor without creating anything '''
+        if isinstance(token, str):
+            return isinstance(parent, dict)
+
+        return isinstance(parent, list) and token <= len(parent)
+
+    @staticmethod
+    def cursor_set(parent, token, item):
+        ''' store an item at a settable cursor, appending to a list when the index is one past the end '''
+        if isinstance(token, int) and token == len(parent):
+            parent.append(item)
+        else:
+            parent[token] = item
+
     # pylint: disable=too-many-return-statements,too-many-branches
     @staticmethod
     def remove_entry(data, key, index=None, value=None, sep='.'):
         ''' remove data at location key '''
-        if key == '' and isinstance(data, dict):
+        key_indexes = Yedit.key_tokens(key, sep)
+        if key_indexes == () and isinstance(data, dict):
             if value is not None:
                 data.pop(value)
             elif index is not None:
@@ -278,7 +1592,7 @@ class Yedit:
 
             return True
 
-        elif key == '' and isinstance(data, list):
+        elif key_indexes == () and isinstance(data, list):
             ind = None
             if value is not None:
                 try:
@@ -295,178 +1609,729 @@ class Yedit:
 
             return True
 
-        if not (key and Yedit.valid_key(key, sep)) and \
-           isinstance(data, (list, dict)):
+        if not key_indexes:
             return None
 
-        key_indexes = Yedit.parse_key(key, sep)
-        for arr_ind, dict_key in key_indexes[:-1]:
-            if dict_key and isinstance(data, dict):
-                data = data.get(dict_key)
-            elif (arr_ind and isinstance(data, list) and
-                  int(arr_ind) <= len(data) - 1):
-                data = data[int(arr_ind)]
-            else:
-                return None
+        cursor = Yedit.cursor(data, key_indexes)
+        if cursor is None:
+            return None
 
+        data, token = cursor
         # process last index for remove
         # expected list entry
-        if key_indexes[-1][0]:
-            if isinstance(data, list) and int(key_indexes[-1][0]) <= len(data) - 1:  # noqa: E501
-                del data[int(key_indexes[-1][0])]
+        if isinstance(token, int):
+            if isinstance(data, list) and token < len(data):
+                del data[token]
                 return True
 
         # expected dict entry
-        elif key_indexes[-1][1]:
-            if isinstance(data, dict):
-                del data[key_indexes[-1][1]]
-                return True
+        elif isinstance(data, dict):
+            del data[token]
+            return True
+
+    @staticmethod
+    def add_entry(data, key, item=None, sep='.'):
+        ''' Get an item from a dictionary with key notation a.b.c
+            d = {'a': {'b': 'c'}}}
+            key = a#b
+            return c
+        '''
+        key_indexes = Yedit.key_tokens(key, sep)
+        if key_indexes is None:
+            return None
+
+        if not key_indexes:
+            return item
+
+        data, token = Yedit.cursor(data, key_indexes, create=True, key=key)
+
+        # didn't add/update to an existing list, nor add/update key to a dict
+        # so we must have been provided some syntax like a.b.c[<int>] = "data" for a
+        # non-existent array
+        if not Yedit.cursor_settable(data, token):
+            raise YeditException("Error adding to object at path: {0}".format(key))
+
+        Yedit.cursor_set(data, token, item)
+
+        return data
+
+    @staticmethod
+    def get_entry(data, key, sep='.'):
+        ''' Get an item from a dictionary with key notation a.b.c
+            d = {'a': {'b': 'c'}}}
+            key = a.b
+            return c
+        '''
+        key_indexes = Yedit.key_tokens(key, sep)
+        if key_indexes is None:
+            return None
+
+        if not key_indexes:
+            return data
+
+        cursor = Yedit.cursor(data, key_indexes)
+        if cursor is None:
+            return None
+
+        return Yedit.cursor_get(*cursor)
+
+    durability_modes = ('full', 'data-only', 'none')
+
+    @staticmethod
+    def _fsync(fd, durability='full', debug_info=None, directory=False):
+        ''' Flush fd to disk as far as durability asks for, adding the time spent to debug_info.
+
+            full syncs files and directories, data-only only the data of files
+            and none nothing at all.
+        '''
+        if durability == 'none' or (directory and durability != 'full'):
+            return
+
+        start = time.monotonic()
+        try:
+            if durability == 'data-only' and hasattr(os, 'fdatasync'):
+                os.fdatasync(fd)
+            else:
+                os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            if debug_info is not None:
+                debug_info['fsync_time'] = debug_info.get('fsync_time', 0.0) + time.monotonic() - start
+
+    # ioctl to share the extents of a file, from linux/fs.h
+    FICLONE = 0x40049409
+
+    @staticmethod
+    def copy_file(source, target):
+        ''' Copy source and its permissions to target, returning how it was copied.
+
+            A reflink is tried first, which shares the data on file systems
+            like XFS and btrfs, then copy_file_range, which copies in the
+            kernel, and finally a plain copy.
+        '''
+        with open(source, 'rb') as src, open(target, 'wb') as dst:
+            method = 'copy'
+            try:
+                fcntl.ioctl(dst.fileno(), Yedit.FICLONE, src.fileno())
+                method = 'reflink'
+            except OSError:
+                if hasattr(os, 'copy_file_range'):
+                    try:
+                        while os.copy_file_range(src.fileno(), dst.fileno(), 1 << 30):
+                            pass
+                        method = 'copy_file_range'
+                    except OSError:
+                        src.seek(0)
+                        dst.seek(0)
+                        dst.truncate()
+
+            if method == 'copy':
+                shutil.copyfileobj(src, dst)
+
+        shutil.copymode(source, target)
+        return method
+
+    def _backup(self):
+        ''' back up the file, noting how and how fast in debug_info '''
+        start = time.monotonic()
+        if self.backup_store is not None:
+            self.debug_info['backup_method'] = 'store'
+            self.debug_info['backup_hash'] = self.backup_store.add(self.filename)['hash']
+        else:
+            self.debug_info['backup_method'] = Yedit.copy_file(self.filename,
+                                                               '{0}{1}'.format(self.filename, self.backup_ext))
+        self.debug_info['backup_time'] = time.monotonic() - start
+
+    @staticmethod
+    def _tmp_file(filename):
+        ''' Open a temp file in the directory of filename, as a (fd, path) tuple.
+
+            On Linux the file is anonymous (O_TMPFILE) and path is None until it
+            is linked by _link_tmp_file, elsewhere it gets a unique name.
+        '''
+        directory = os.path.dirname(filename) or '.'
+        if hasattr(os, 'O_TMPFILE'):
+            try:
+                return (os.open(directory, os.O_TMPFILE | os.O_RDWR, 0o600), None)
+            except OSError:
+                # not supported by the file system
+                pass
+
+        return tempfile.mkstemp(prefix='.{0}.'.format(os.path.basename(filename)), suffix='.yedit', dir=directory)
+
+    @staticmethod
+    def _link_tmp_file(fd, filename):
+        ''' give the anonymous temp file fd a unique name next to filename and return it '''
+        directory = os.path.dirname(filename) or '.'
+        dir_fd = os.open(directory, os.O_DIRECTORY)
+        try:
+            while True:
+                name = '.{0}.{1}.yedit'.format(os.path.basename(filename), os.urandom(6).hex())
+                try:
+                    # a dir_fd makes this a linkat() that follows the /proc link to the file
+                    os.link('/proc/self/fd/{0}'.format(fd), name, dst_dir_fd=dir_fd)
+                    return os.path.join(directory, name)
+                except FileExistsError:
+                    continue
+                except OSError:
+                    break
+        finally:
+            os.close(dir_fd)
+
+        # /proc is not available, copy the contents to a named temp file instead
+        tmp_fd, path = tempfile.mkstemp(prefix='.{0}.'.format(os.path.basename(filename)), suffix='.yedit',
+                                        dir=directory)
+        with open(os.dup(fd), 'rb') as source, open(tmp_fd, 'wb') as target:
+            source.seek(0)
+            shutil.copyfileobj(source, target)
+            os.fchmod(target.fileno(), os.fstat(source.fileno()).st_mode)
+        return path
+
+    @staticmethod
+    def _write(filename, write_func, durability='full', debug_info=None, check=None):
+        ''' Actually write the file contents to disk. This helps with mocking.
+
+            The contents go to a temp file that is renamed over filename, so
+            readers see either the old or the new file and concurrent writers
+            never share a temp file.  The file is left alone when write_func
+            returns False or raises.  check returns a context manager that is
+            held around the rename, and raises when it must not happen.
+            Returns whether the file was replaced.
+        '''
+        try:
+            mode = os.stat(filename).st_mode & 0o7777
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+
+        fd, tmp_filename = Yedit._tmp_file(filename)
+        try:
+            os.fchmod(fd, mode)
+            with open(fd, 'w', closefd=False) as yfd:
+                if write_func(yfd) is False:
+                    return False
+                yfd.flush()  # flush internal buffers
+                # ensure buffer content reached disk
+                Yedit._fsync(fd, durability, debug_info)
+
+            with check() if check is not None else contextlib.nullcontext():
+                if tmp_filename is None:
+                    tmp_filename = Yedit._link_tmp_file(fd, filename)
+                os.rename(tmp_filename, filename)
+                tmp_filename = None
+        finally:
+            os.close(fd)
+            if tmp_filename is not None:
+                os.unlink(tmp_filename)
+
+        # While the rename is atomic, we also need to ensure, that the updated
+        # directory entry has reached the disk too.
+        # NOTE: this might fail on Windows systems.
+        if durability != 'full':
+            return True
+
+        dfd = None
+        try:
+            dfd = os.open(os.path.join(os.path.realpath('.'), os.path.dirname(filename)), os.O_DIRECTORY)
+            Yedit._fsync(dfd, durability, debug_info, directory=True)
+        except:
+            pass
+        finally:
+            if dfd:
+                os.close(dfd)
+
+        return True
+
+    scalar_types = (str, int, float, bool)
+
+    def _track_splice(self, parent, token, value):
+        ''' remember that the scalar at parent[token] is replaced by the scalar value,
+            returns False when the change cannot be written as a splice
+        '''
+        if not self.splice or self._structural or not hasattr(parent, 'lc'):
+            return False
+
+        if isinstance(parent, list):
+            if not -len(parent) <= token < len(parent):
+                return False
+            token %= len(parent)
+        elif token not in parent:
+            return False
+
+        if not isinstance(parent[token], Yedit.scalar_types) or not isinstance(value, Yedit.scalar_types):
+            return False
+
+        self._splices.setdefault((id(parent), token), (parent, token, parent[token]))
+        return True
+
+    @staticmethod
+    def _line_starts(text):
+        ''' offsets of every line in text, using the line breaks yaml recognizes '''
+        starts = [0]
+        starts.extend(match.end() for match in re.finditer('\r\n|[\n\r\x85\u2028\u2029]', text))
+        return starts
+
+    @staticmethod
+    def _scalar_span(text, line_starts, parent, token, old):
+        ''' return the (start, end) offsets of the scalar parent[token] in text, or None '''
+        try:
+            if isinstance(parent, list):
+                line, col = parent.lc.item(token)
+            else:
+                line, col = parent.lc.value(token)
+        except (KeyError, IndexError, TypeError):
+            return None
+
+        # plain scalars end differently inside flow collections
+        if parent.fa.flow_style() or line >= len(line_starts):
+            return None
+
+        start = line_starts[line] + col
+        end = line_starts[line + 1] if line + 1 < len(line_starts) else len(text)
+        try:
+            scalar = list(itertools.islice(default_yaml.scan(text[start:end]), 2))[-1]
+        except yaml.YAMLError:
+            return None
+
+        if not isinstance(scalar, yaml.tokens.ScalarToken) or scalar.style in ('|', '>') or \
+           scalar.start_mark.index != 0 or scalar.end_mark.line != 0:
+            return None
+
+        # the line may only hold the start of a multi-line scalar
+        end = start + scalar.end_mark.index
+        try:
+            if safe_yaml.load(text[start:end]) != old:
+                return None
+        except yaml.YAMLError:
+            return None
+
+        return (start, end)
+
+    @staticmethod
+    def _scalar_text(value):
+        ''' serialize a scalar for use in place of another one, None when it needs several lines '''
+        stream = io.StringIO()
+        default_yaml.dump(value, stream)
+        text = stream.getvalue()
+        if text.endswith('\n...\n'):
+            text = text[:-5]
+        text = text.rstrip('\n')
+        if '\n' in text or '\r' in text:
+            return None
+
+        return text
+
+    def _splice_contents(self):
+        ''' the text read from the file with only the changed scalars rewritten,
+            None when the changes cannot be written this way
+        '''
+        if not self.splice or self._structural or self._source is None or \
+           self.content_type != 'yaml' or self._source.startswith('\ufeff'):
+            return None
+
+        line_starts = None
+        replacements = []
+        for parent, token, old in self._splices.values():
+            new = parent[token]
+            if new == old and type(new) is type(old):
+                continue
+
+            if line_starts is None:
+                line_starts = Yedit._line_starts(self._source)
+
+            span = Yedit._scalar_span(self._source, line_starts, parent, token, old)
+            new_text = Yedit._scalar_text(new)
+            if span is None or new_text is None:
+                return None
+            replacements.append((span, new_text))
+
+        contents = self._source
+        for (start, end), new_text in sorted(replacements, reverse=True):
+            contents = contents[:start] + new_text + contents[end:]
+
+        return contents
+
+    def dumps(self):
+        ''' serialize the document the way it is written to the file '''
+        if self._sections is not None:
+            return self._sparse_dumps()
+
+        # Try to use RoundTripDumper if supported.
+        if self.content_type == 'yaml':
+            stream = io.StringIO()
+            default_yaml.dump(self.yaml_dict, stream)
+            return stream.getvalue()
+        elif self.content_type == 'json':
+            return json.dumps(self.yaml_dict, indent=4, sort_keys=True)
+
+        raise YeditException('Unsupported content_type: {0}.'.format(self.content_type) +
+                             'Please specify a content_type of yaml or json.')
+
+    def write(self):
+        ''' write to file, unless the serialized document matches what was read from it '''
+        if not self.filename:
+            raise YeditException('Please specify a filename.')
+
+        if self.read_only:
+            raise YeditException('Cannot write {0}, it was opened read-only.'.format(self.filename))
+
+        head = self._head
+        contents = self._splice_contents()
+        if contents is None:
+            contents = self.dumps()
+            # positions recorded when loading no longer match the text written
+            self._structural = True
+            # a document cut out of a stream keeps the line breaks of the stream
+            newline = '\r\n' if '\r\n' in self._head + self._tail else '\n'
+            if newline != '\n':
+                contents = contents.replace('\n', newline)
+            # a document that started on its `---` line is dumped on lines of its own
+            if head and not head.endswith('\n'):
+                head += newline
+
+        if contents == self._source and self.file_exists():
+            return (False, self._doc)
+
+        if self.backup and self.file_exists():
+            self._backup()
+
+        Yedit._write(self.filename, lambda f: f.write(head + contents + self._tail),
+                     self.durability, self.debug_info, self._replacing)
+        self._source = contents
+        self._splices = {}
+
+        return (True, self._doc)
+
+    def append_in_place(self, path, value):
+        ''' Append value to a list by writing only the new text at the end of the file.
+
+            This is done for the top level array of a json file, and for the
+            top level block sequence or the block sequence of the last top level
+            key of a yaml file, as long as the document was not loaded.
+            Returns whether the value was appended, append() has to be used otherwise.
+        '''
+        tokens = Yedit.key_tokens(path, self.separator)
+        if tokens is None or not self._lazy or self.content or self.read_only or \
+           self.document is not None or self.filename is None or not self.file_exists():
+            return False
+
+        text = self.read()
+        if not text or '\r' in text:
+            return False
+
+        if self.content_type == 'json':
+            addition = Yedit._json_append_text(text, tokens, value)
+        else:
+            addition = Yedit._yaml_append_text(text, tokens, value)
+        if addition is None:
+            return False
+
+        if self.backup:
+            self._backup()
+
+        cut, new_text = addition
+        with self._replacing(), open(self.filename, 'r+b') as yfd:
+            yfd.seek(os.fstat(yfd.fileno()).st_size - len(text[cut:].encode('utf-8')))
+            yfd.write(new_text.encode('utf-8'))
+            yfd.flush()
+            Yedit._fsync(yfd.fileno(), self.durability, self.debug_info)
+
+        self._source = text[:cut] + new_text
+        return True
+
+    @staticmethod
+    def _yaml_append_text(text, tokens, value):
+        ''' the (offset, text) to write at the end of a yaml document to append value, or None '''
+        if tokens == ():
+            # every line in the first column has to start an item of the top level sequence
+            if Yedit.re_root_other.search(text) or not Yedit.re_root_item.search(text):
+                return None
+            indent = ''
+
+        elif len(tokens) == 1 and isinstance(tokens[0], str):
+            sections = Yedit.split_sections(text)
+            if sections is None or sections[-1][0] != tokens[0]:
+                return None
+
+            section = sections[-1][1]
+            key_line = Yedit.re_section_line.search(section)
+            if not re.search(r':[ \t]*(#.*)?$', key_line.group(0)):
+                return None
+
+            indent = None
+            for line in section[key_line.end():].splitlines():
+                if not line.strip() or line.lstrip().startswith('#'):
+                    continue
+                if '\t' in line[:len(line) - len(line.lstrip())]:
+                    return None
+                if indent is None:
+                    item = Yedit.re_root_item.match(line.lstrip(' '))
+                    if item is None:
+                        return None
+                    indent = line[:len(line) - len(line.lstrip(' '))]
+                elif len(line) - len(line.lstrip(' ')) <= len(indent) and \
+                        not (line.startswith(indent) and Yedit.re_root_item.match(line[len(indent):])):
+                    return None
+            if indent is None:
+                return None
+
+        else:
+            return None
+
+        stream = io.StringIO()
+        default_yaml.dump([value], stream)
+        new_text = ''.join(indent + line if line.strip() else line
+                           for line in stream.getvalue().splitlines(True))
+        if not text.endswith('\n'):
+            new_text = '\n' + new_text
+        return (len(text), new_text)
 
     @staticmethod
-    def add_entry(data, key, item=None, sep='.'):
-        ''' Get an item from a dictionary with key notation a.b.c
-            d = {'a': {'b': 'c'}}}
-            key = a#b
-            return c
-        '''
-        if key == '':
-            pass
-        elif (not (key and Yedit.valid_key(key, sep)) and
-              isinstance(data, (list, dict))):
+    def _json_append_text(text, tokens, value):
+        ''' the (offset, text) that replace the end of a json array to append value, or None '''
+        stripped = text.rstrip()
+        if tokens != () or not stripped.endswith(']') or not text.lstrip().startswith('['):
             return None
 
-        key_indexes = Yedit.parse_key(key, sep)
-        for arr_ind, dict_key in key_indexes[:-1]:
-            if dict_key:
-                if isinstance(data, dict) and dict_key in data and data[dict_key]:  # noqa: E501
-                    data = data[dict_key]
-                    continue
-
-                elif data and not isinstance(data, dict):
-                    raise YeditException("Unexpected item type found while going through key " +
-                                         "path: {0} (at key: {1})".format(key, dict_key))
+        cut = len(stripped[:-1].rstrip())
+        item = json.dumps(value, indent=4, sort_keys=True).replace('\n', '\n    ')
+        separator = '\n' if text[:cut].strip() == '[' else ',\n'
+        return (cut, separator + '    ' + item + '\n' + text[len(stripped) - 1:])
 
-                data[dict_key] = {}
-                data = data[dict_key]
+    def stream_edits(self, edits):
+        ''' apply edits straight from the file to its replacement, without loading the document.
 
-            elif (arr_ind and isinstance(data, list) and
-                  int(arr_ind) <= len(data) - 1):
-                data = data[int(arr_ind)]
-            else:
-                raise YeditException("Unexpected item type found while going through key path: {0}".format(key))
+            Returns a (changed, keys) tuple, keys being those of the edits that
+            changed something.  See YeditStreamEditor for the supported edits.
+        '''
+        if self.read_only:
+            raise YeditException('Cannot write {0}, it was opened read-only.'.format(self.filename))
 
-        if key == '':
-            data = item
+        editor = YeditStreamEditor.from_edits(edits, self.separator)
 
-        # process last index for add
-        # expected list entry
-        elif key_indexes[-1][0] and isinstance(data, list) and int(key_indexes[-1][0]) <= len(data):  # noqa: E501
-            # key is next element in array so append
-            if int(key_indexes[-1][0]) > len(data)-1:
-                data.append(item)
-            else:
-                data[int(key_indexes[-1][0])] = item
+        def write_func(target):
+            with open(self.filename) as source:
+                if self.optimistic:
+                    self._read_stamp = (Yedit._stat_stamp(os.fstat(source.fileno())), None)
+                if not editor.run(source, target):
+                    return False
 
-        # expected dict entry
-        elif key_indexes[-1][1] and isinstance(data, dict):
-            data[key_indexes[-1][1]] = item
+            if self.backup:
+                self._backup()
+            return True
 
-        # didn't add/update to an existing list, nor add/update key to a dict
-        # so we must have been provided some syntax like a.b.c[<int>] = "data" for a
-        # non-existent array
-        else:
-            raise YeditException("Error adding to object at path: {0}".format(key))
+        changed = Yedit._write(self.filename, write_func, self.durability, self.debug_info, self._replacing)
+        return (changed, [edits[index]['key'] for index in sorted(editor.changed)])
 
-        return data
+    def restore_backup(self, position=-1):
+        ''' Put back the backup at position in backup_store.
 
-    @staticmethod
-    def get_entry(data, key, sep='.'):
-        ''' Get an item from a dictionary with key notation a.b.c
-            d = {'a': {'b': 'c'}}}
-            key = a.b
-            return c
+            The file is replaced like by write, with its durability and, in
+            optimistic mode, its conflict check.  Returns a (changed, entry)
+            tuple, entry being the index entry of the backup.
         '''
-        if key == '':
-            pass
-        elif (not (key and Yedit.valid_key(key, sep)) and
-              isinstance(data, (list, dict))):
-            return None
+        if self.read_only:
+            raise YeditException('Cannot write {0}, it was opened read-only.'.format(self.filename))
 
-        key_indexes = Yedit.parse_key(key, sep)
-        for arr_ind, dict_key in key_indexes:
-            if dict_key and isinstance(data, dict):
-                data = data.get(dict_key)
-            elif (arr_ind and isinstance(data, list) and
-                  int(arr_ind) <= len(data) - 1):
-                data = data[int(arr_ind)]
-            else:
-                return None
+        if self.optimistic:
+            self._read_stamp = (self.file_stamp(), None)
 
-        return data
+        backups = self.backup_store.backups(self.filename)
+        try:
+            entry = backups[position]
+        except IndexError:
+            raise YeditException('No backup {0} of {1}, there are {2}.'.format(position, self.filename, len(backups)))
 
-    @staticmethod
-    def _write(filename, write_func):
-        ''' Actually write the file contents to disk. This helps with mocking. '''
+        if Yedit.file_hash(self.filename) == entry['hash']:
+            return (False, entry)
 
-        tmp_filename = filename + '.yedit'
+        contents = self.backup_store.contents(self.filename, position)
+        Yedit._write(self.filename, lambda f: f.write(contents), self.durability, self.debug_info, self._replacing)
+        return (True, entry)
 
-        original_mode = os.stat(filename).st_mode
-        fd = os.open(tmp_filename, flags=(os.O_WRONLY | os.O_CREAT | os.O_TRUNC), mode=original_mode)
-        with open(fd, 'w') as yfd:
-            fcntl.flock(yfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-            write_func(yfd)
-            yfd.flush()  # flush internal buffers
-            try:
-                os.fsync(yfd.fileno())  # ensure buffer content reached disk
-            except:
-                pass
-            fcntl.flock(yfd, fcntl.LOCK_UN)
+    def acquire_lock(self, shared=False, timeout=None):
+        ''' Lock the file for a load, edit and write cycle, until release_lock.
 
-        os.rename(tmp_filename, filename)
-        # While the rename is atomic, we also need to ensure, that the updated
-        # directory entry has reached the disk too.
-        # NOTE: this might fail on Windows systems.
-        dfd = None
-        try:
-            dfd = os.open(os.path.join(os.path.realpath('.'), os.path.dirname(filename)), os.O_DIRECTORY)
-            os.fsync(dfd)
-        except:
-            pass
-        finally:
-            if dfd:
-                os.close(dfd)
+            The lock is taken on filename + '.yedit.lock', which unlike the
+            file itself is never replaced, so every Yedit agreeing on it is
+            serialized.  Writers need an exclusive lock, readers can share one.
+            Waits at most timeout seconds, or forever when it is None.
+        '''
+        if self._lock_fd is not None:
+            raise YeditException('{0} is already locked.'.format(self.filename))
 
-    def write(self):
-        ''' write to file '''
-        if not self.filename:
-            raise YeditException('Please specify a filename.')
+        start = time.monotonic()
+        self._lock_fd = Yedit._lock(self.filename, shared, timeout)
+        self.debug_info['lock_wait'] = time.monotonic() - start
 
-        if self.backup and self.file_exists():
-            shutil.copy(self.filename, '{0}{1}'.format(self.filename, self.backup_ext))
+    @staticmethod
+    def _lock(filename, shared=False, timeout=None):
+        ''' flock filename + '.yedit.lock', returning the fd holding the lock '''
+        lock_filename = filename + '.yedit.lock'
+        try:
+            fd = os.open(lock_filename, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as err:
+            raise YeditException('Cannot open the lock file {0}: {1}'.format(lock_filename, err))
+
+        operation = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB
+        start = time.monotonic()
+        delay = 0.005
+        while True:
+            try:
+                fcntl.flock(fd, operation)
+                return fd
+            except BlockingIOError:
+                waited = time.monotonic() - start
+                if timeout is not None and waited >= timeout:
+                    os.close(fd)
+                    raise YeditException('Timed out after {0} seconds waiting for the lock on {1}.'.format(
+                        timeout, filename))
+                time.sleep(delay if timeout is None else min(delay, timeout - waited))
+                delay = min(delay * 2, 0.1)
 
-        # Try to use RoundTripDumper if supported.
-        if self.content_type == 'yaml':
-            Yedit._write(self.filename, lambda f: default_yaml.dump(self.yaml_dict, f))
-        elif self.content_type == 'json':
-            Yedit._write(self.filename, lambda f: json.dump(self.yaml_dict, f, indent=4, sort_keys=True))
-        else:
-            raise YeditException('Unsupported content_type: {0}.'.format(self.content_type) +
-                                 'Please specify a content_type of yaml or json.')
+    @staticmethod
+    def _unlock(fd):
+        ''' release a lock taken by _lock '''
+        # the lock file stays, removing it would let a waiting process lock a file nobody else sees
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def release_lock(self):
+        ''' release the lock taken by acquire_lock, if any '''
+        if self._lock_fd is None:
+            return
 
-        return (True, self.yaml_dict)
+        Yedit._unlock(self._lock_fd)
+        self._lock_fd = None
 
     def read(self):
         ''' read from file '''
         # check if it exists
         if self.filename is None or not self.file_exists():
+            if self.optimistic:
+                self._read_stamp = (None, None)
             return None
 
         contents = None
-        with open(self.filename) as yfd:
+        # keep line endings as they are so the contents can be compared byte for byte on write
+        with open(self.filename, newline='') as yfd:
+            stat = os.fstat(yfd.fileno())
             contents = yfd.read()
 
+        if self.optimistic:
+            self._read_stamp = (Yedit._stat_stamp(stat), hashlib.sha256(contents.encode('utf-8')).hexdigest())
+        self._source = contents
         return contents
 
+    def _unchanged(self):
+        ''' Whether the file on disk still is the one read.
+
+            The stat of the file is compared first, the contents are only hashed
+            again when just the modification time changed.
+        '''
+        if self._read_stamp is None:
+            return True
+
+        stamp, digest = self._read_stamp
+        current = self.file_stamp()
+        if current == stamp:
+            return True
+        if current is None or stamp is None or current[:3] != stamp[:3] or digest is None:
+            return False
+
+        with open(self.filename, newline='') as yfd:
+            return hashlib.sha256(yfd.read().encode('utf-8')).hexdigest() == digest
+
+    def _check_unchanged(self):
+        ''' raise YeditConflict when the file changed since it was read, in optimistic mode '''
+        if self.optimistic and not self._unchanged():
+            raise YeditConflict('{0} was changed by someone else since it was read.'.format(self.filename))
+
+    @contextlib.contextmanager
+    def _replacing(self):
+        ''' Check that the file is unchanged and keep it that way until it is replaced.
+
+            In optimistic mode the lock of acquire_lock is held for just the
+            check and the replace, otherwise another writer could replace the
+            file in between and its changes would be lost.
+        '''
+        fd = None
+        if self.optimistic and self._lock_fd is None and self.filename:
+            fd = Yedit._lock(self.filename)
+        try:
+            self._check_unchanged()
+            yield
+        finally:
+            if fd is not None:
+                Yedit._unlock(fd)
+
+    fingerprint_xattr = 'user.yedit.fingerprint'
+    # how many sets of edits are remembered per file content
+    fingerprint_size = 64
+
+    @staticmethod
+    def file_hash(filename):
+        ''' the sha256 of the contents of filename, None when it cannot be read '''
+        digest = hashlib.sha256()
+        try:
+            with open(filename, 'rb') as yfd:
+                for chunk in iter(lambda: yfd.read(1 << 20), b''):
+                    digest.update(chunk)
+        except OSError:
+            return None
+
+        return digest.hexdigest()
+
+    @staticmethod
+    def edits_digest(params, edits):
+        ''' a digest of the edits and of the parameters that decide what they do '''
+        normalized = {'edits': edits,
+                      'state': params['state'],
+                      'separator': params['separator'],
+                      'content_type': params['content_type'],
+                      'document': params.get('document')}
+        return hashlib.sha256(json.dumps(normalized, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def read_fingerprint(filename):
+        ''' The fingerprint of filename: the hash of its contents and the digests
+            of the edits known to change nothing in them.
+
+            It is kept in an extended attribute, or in filename + '.yedit.fingerprint'
+            when the file system has none.
+        '''
+        try:
+            data = os.getxattr(filename, Yedit.fingerprint_xattr)
+        except (AttributeError, OSError):
+            try:
+                with open(filename + '.yedit.fingerprint', 'rb') as yfd:
+                    data = yfd.read()
+            except OSError:
+                return None
+
+        try:
+            fingerprint = json.loads(data.decode('utf-8'))
+            return (fingerprint['hash'], fingerprint['edits'])
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    @staticmethod
+    def record_fingerprint(filename, file_hash, edits_digest):
+        ''' remember that the edits with edits_digest change nothing in the contents with file_hash '''
+        edits = []
+        fingerprint = Yedit.read_fingerprint(filename)
+        if fingerprint is not None and fingerprint[0] == file_hash:
+            edits = [digest for digest in fingerprint[1] if digest != edits_digest]
+        edits = (edits + [edits_digest])[-Yedit.fingerprint_size:]
+
+        data = json.dumps({'hash': file_hash, 'edits': edits})
+        try:
+            os.setxattr(filename, Yedit.fingerprint_xattr, data.encode('utf-8'))
+        except (AttributeError, OSError):
+            Yedit._write(filename + '.yedit.fingerprint', lambda f: f.write(data), durability='none')
+
     def file_exists(self):
         ''' return whether file exists '''
         if os.path.exists(self.filename):
@@ -474,13 +2339,44 @@ class Yedit:
 
         return False
 
-    def load(self, content_type='yaml'):
-        ''' return yaml file '''
+    def file_stamp(self):
+        ''' identify the file on disk, so a load can tell whether it changed since '''
+        try:
+            stat = os.stat(self.filename)
+        except (OSError, TypeError):
+            return None
+
+        return Yedit._stat_stamp(stat)
+
+    @staticmethod
+    def _stat_stamp(stat):
+        ''' the parts of a stat result that change when a file is replaced or written '''
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def load(self, content_type=None, reload=False):
+        ''' return yaml file.
+
+            The file is only read and parsed again when it changed on disk since
+            the previous load, or when reload is set.
+        '''
+        if self._lazy:
+            return self._materialize(content_type)
+
+        if content_type is None:
+            content_type = self.content_type
+
+        stamp = self.file_stamp() if self.filename and not self.content else None
+        if not reload and stamp is not None and self._loaded == (stamp, content_type):
+            return self._doc
+
         contents = self.read()
 
         if not contents and not self.content:
             return None
 
+        if self.document is not None and content_type == 'yaml' and not self.content:
+            contents = self.select_document(contents)
+
         if self.content:
             if isinstance(self.content, dict):
                 self.yaml_dict = self.content
@@ -490,8 +2386,16 @@ class Yedit:
 
         # check if it is yaml
         try:
-            if content_type == 'yaml' and contents:
-                self.yaml_dict = default_yaml.load(contents)
+            sections = None
+            if content_type == 'yaml' and contents and self.sparse and not self.read_only and not self.content:
+                sections = Yedit.split_sections(contents)
+
+            if sections is not None:
+                self._start_sparse(sections)
+
+            elif content_type == 'yaml' and contents:
+                loader = safe_yaml if self.read_only else default_yaml
+                self.yaml_dict = loader.load(contents)
 
             elif content_type == 'json' and contents:
                 self.yaml_dict = json.loads(contents)
@@ -499,34 +2403,210 @@ class Yedit:
             # Error loading yaml or json
             raise YeditException(f'Problem with loading yaml file. {err}')
 
-        return self.yaml_dict
+        self._loaded = (stamp, content_type) if stamp is not None else None
+        # the document now matches the text read from the file
+        self._structural = bool(self.content) or self._sections is not None
+        self._splices = {}
+
+        return self._doc
 
     def get(self, key):
         ''' get a specified key'''
+        self._expand(key)
         try:
-            entry = Yedit.get_entry(self.yaml_dict, key, self.separator)
+            entry = Yedit.get_entry(self._doc, key, self.separator)
         except KeyError:
             entry = None
 
         return entry
 
+    def stream_lookup(self, key):
+        ''' get a key straight from the parse events of the file, without loading the document.
+
+            Returns a (found, value) tuple.  found is False when the document is
+            already loaded, is not yaml, or the lookup needs a full load, in which
+            case get() has to be used instead.
+        '''
+        tokens = Yedit.key_tokens(key, self.separator)
+        if not tokens or not self._lazy or self.content or self.content_type != 'yaml' or \
+           self.document is not None:
+            return (False, None)
+
+        try:
+            with open(self.filename) as stream:
+                return Yedit.stream_get(stream, tokens)
+        except (OSError, TypeError):
+            return (False, None)
+
+    @staticmethod
+    def stream_get(stream, tokens):
+        ''' Look up tokens by walking the parse events of a yaml stream.
+
+            The path is followed event by event, only the node found at the end
+            of it is materialized and parsing stops as soon as that node is
+            complete.  Returns a (found, value) tuple, found is False when the
+            stream uses something the walk cannot follow (aliases, merge keys,
+            tags or no document at all) and a full load is needed.
+        '''
+        events = safe_yaml.parse(stream)
+        try:
+            if not isinstance(next(events), yaml_events.StreamStartEvent) or \
+               not isinstance(next(events), yaml_events.DocumentStartEvent):
+                return (False, None)
+
+            event = next(events)
+            for token in tokens:
+                if isinstance(event, yaml_events.AliasEvent) or getattr(event, 'tag', None) is not None:
+                    return (False, None)
+
+                if isinstance(token, str) and isinstance(event, yaml_events.MappingStartEvent):
+                    event = Yedit._stream_find_key(events, token)
+                elif isinstance(token, int) and isinstance(event, yaml_events.SequenceStartEvent):
+                    if token < 0:
+                        return (False, None)
+                    event = Yedit._stream_find_index(events, token)
+                else:
+                    return (True, None)
+
+                if event is None:
+                    return (False, None)
+                if event is _MISSING:
+                    return (True, None)
+
+            return Yedit._stream_node(events, event)
+        except (yaml.YAMLError, StopIteration):
+            return (False, None)
+        finally:
+            events.close()
+
+    @staticmethod
+    def _stream_skip(events, event):
+        ''' consume the rest of the node that starts with event '''
+        if not isinstance(event, yaml_events.CollectionStartEvent):
+            return
+
+        depth = 1
+        while depth:
+            event = next(events)
+            if isinstance(event, yaml_events.CollectionStartEvent):
+                depth += 1
+            elif isinstance(event, yaml_events.CollectionEndEvent):
+                depth -= 1
+
+    @staticmethod
+    def _stream_find_key(events, token):
+        ''' return the first event of the value for token in the current mapping,
+            _MISSING when the mapping has no such key and None when it cannot be told
+        '''
+        str_tag = 'tag:yaml.org,2002:str'
+        while True:
+            event = next(events)
+            if isinstance(event, yaml_events.MappingEndEvent):
+                return _MISSING
+
+            if isinstance(event, yaml_events.AliasEvent) or event.tag is not None:
+                return None
+
+            match = False
+            if isinstance(event, yaml_events.ScalarEvent):
+                if event.implicit[0] and event.value == '<<':
+                    return None
+                match = event.value == token and \
+                    (not event.implicit[0] or
+                     safe_yaml.resolver.resolve(ScalarNode, event.value, (True, False)) == str_tag)
+            else:
+                Yedit._stream_skip(events, event)
+
+            event = next(events)
+            if match:
+                return event
+            Yedit._stream_skip(events, event)
+
+    @staticmethod
+    def _stream_find_index(events, index):
+        ''' return the first event of item index in the current sequence or _MISSING '''
+        position = 0
+        while True:
+            event = next(events)
+            if isinstance(event, yaml_events.SequenceEndEvent):
+                return _MISSING
+            if position == index:
+                return event
+            Yedit._stream_skip(events, event)
+            position += 1
+
+    @staticmethod
+    def _stream_copy(events, event):
+        ''' yield the rest of the node that starts with event '''
+        if not isinstance(event, yaml_events.CollectionStartEvent):
+            return
+
+        depth = 1
+        while depth:
+            event = next(events)
+            yield event
+            if isinstance(event, yaml_events.CollectionStartEvent):
+                depth += 1
+            elif isinstance(event, yaml_events.CollectionEndEvent):
+                depth -= 1
+
+    @staticmethod
+    def _stream_node(events, event):
+        ''' materialize the node that starts with event '''
+        return Yedit._stream_value([event] + list(Yedit._stream_copy(events, event)))
+
+    @staticmethod
+    def _stream_emittable(events):
+        ''' pass on parse events, completing the scalars so the emitter accepts them.
+
+            The emitter expects scalars as the serializer makes them: with a
+            third implicit flag and a tag object even when there is no tag, the
+            parser gives neither, which breaks on empty and explicitly tagged
+            scalars.  Clearing the third flag keeps plain scalars plain.
+        '''
+        for event in events:
+            if isinstance(event, yaml_events.ScalarEvent):
+                if len(event.implicit) < 3:
+                    event.implicit = tuple(event.implicit[:2]) + (False,)
+                if event.ctag is None:
+                    event.ctag = Tag(suffix='!')
+            yield event
+
+    @staticmethod
+    def _stream_value(node_events):
+        ''' materialize the node made of node_events, as a (found, value) tuple '''
+        anchors = set()
+        for event in node_events:
+            if isinstance(event, yaml_events.AliasEvent) and event.anchor not in anchors:
+                return (False, None)
+            if getattr(event, 'anchor', None) is not None:
+                anchors.add(event.anchor)
+
+        text = io.StringIO()
+        safe_yaml.emit(Yedit._stream_emittable(
+            [yaml_events.StreamStartEvent(), yaml_events.DocumentStartEvent()] + node_events +
+            [yaml_events.DocumentEndEvent(), yaml_events.StreamEndEvent()]), text)
+
+        return (True, safe_yaml.load(text.getvalue()))
+
     def pop(self, path, key_or_item):
         ''' remove a key, value pair from a dict or an item for a list'''
+        self._expand(path, dirty=True)
         try:
-            entry = Yedit.get_entry(self.yaml_dict, path, self.separator)
+            entry = Yedit.get_entry(self._doc, path, self.separator)
         except KeyError:
             entry = None
 
         if entry is None:
-            return (False, self.yaml_dict)
+            return (False, self._doc)
 
         if isinstance(entry, dict):
             # AUDIT:maybe-no-member makes sense due to fuzzy types
             # pylint: disable=maybe-no-member
             if key_or_item in entry:
-                entry.pop(key_or_item)
-                return (True, self.yaml_dict)
-            return (False, self.yaml_dict)
+                self._journal().del_item(entry, key_or_item)
+                return (True, self._doc)
+            return (False, self._doc)
 
         elif isinstance(entry, list):
             # AUDIT:maybe-no-member makes sense due to fuzzy types
@@ -535,33 +2615,66 @@ class Yedit:
             try:
                 ind = entry.index(key_or_item)
             except ValueError:
-                return (False, self.yaml_dict)
+                return (False, self._doc)
+
+            self._journal().del_item(entry, ind)
+            return (True, self._doc)
+
+        return (False, self._doc)
+
+    def _remove_root(self, index=None, value=None):
+        ''' remove an item, a key or everything from the top of the document '''
+        undo = self._journal()
+        data = self._doc
+        if isinstance(data, dict):
+            if value is not None:
+                undo.del_item(data, value)
+            elif index is not None:
+                raise YeditException("remove_entry for a dictionary does not have an index {0}".format(index))
+            else:
+                undo.clear(data)
 
-            entry.pop(ind)
-            return (True, self.yaml_dict)
+            return True
+
+        elif isinstance(data, list):
+            if value is not None:
+                try:
+                    index = data.index(value)
+                except ValueError:
+                    return False
+
+            if index is not None:
+                undo.del_item(data, index)
+            else:
+                undo.clear(data)
 
-        return (False, self.yaml_dict)
+            return True
+
+        return False
 
     def delete(self, path, index=None, value=None):
         ''' remove path from a dict'''
-        try:
-            entry = Yedit.get_entry(self.yaml_dict, path, self.separator)
-        except KeyError:
-            entry = None
+        self._expand(path, dirty=True)
+        tokens = Yedit.key_tokens(path, self.separator)
+        if tokens is None or self._doc is None:
+            return (False, self._doc)
 
-        if entry is None:
-            return (False, self.yaml_dict)
+        if not tokens:
+            return (self._remove_root(index, value), self._doc)
+
+        cursor = Yedit.cursor(self._doc, tokens)
+        if cursor is None or Yedit.cursor_get(*cursor) is None:
+            return (False, self._doc)
 
-        result = Yedit.remove_entry(self.yaml_dict, path, index, value, self.separator)
-        if not result:
-            return (False, self.yaml_dict)
+        self._journal().del_item(*cursor)
 
-        return (True, self.yaml_dict)
+        return (True, self._doc)
 
     def exists(self, path, value):
         ''' check if value exists at path'''
+        self._expand(path)
         try:
-            entry = Yedit.get_entry(self.yaml_dict, path, self.separator)
+            entry = Yedit.get_entry(self._doc, path, self.separator)
         except KeyError:
             entry = None
 
@@ -585,46 +2698,66 @@ class Yedit:
 
         return entry == value
 
-    def append(self, path, value):
-        '''append value to a list'''
-        try:
-            entry = Yedit.get_entry(self.yaml_dict, path, self.separator)
-        except KeyError:
-            entry = None
+    def _list_entry(self, path):
+        '''return the entry at path, creating an empty list when it does not exist or is null'''
+        self._expand(path, dirty=True)
+        tokens = Yedit.key_tokens(path, self.separator)
+        if tokens is None:
+            return None
+
+        cursor = None
+        if tokens:
+            cursor = Yedit.cursor(self._doc, tokens)
+            entry = Yedit.cursor_get(*cursor) if cursor is not None else None
+        else:
+            entry = self._doc
 
         if entry is None:
-            self.put(path, [])
-            entry = Yedit.get_entry(self.yaml_dict, path, self.separator)
+            entry = []
+            if cursor is not None and Yedit.cursor_settable(*cursor):
+                self._journal().set_item(*cursor, entry)
+            elif not self.put(tokens, entry)[0]:
+                return None
+
+        return entry
+
+    def append(self, path, value):
+        '''append value to a list'''
+        entry = self._list_entry(path)
         if not isinstance(entry, list):
-            return (False, self.yaml_dict)
+            return (False, self._doc)
 
         # AUDIT:maybe-no-member makes sense due to loading data from
         # a serialized format.
         # pylint: disable=maybe-no-member
-        entry.append(value)
-        return (True, self.yaml_dict)
+        self._journal().set_item(entry, len(entry), value)
+        return (True, self._doc)
 
     def insert(self, path, value, index=0):
-        '''insert value to a list'''
-        try:
-            entry = Yedit.get_entry(self.yaml_dict, path, self.separator)
-        except KeyError:
-            entry = None
+        '''insert value to a list.
 
-        if entry is None:
-            self.put(path, [])
-            entry = Yedit.get_entry(self.yaml_dict, path, self.separator)
+           Nothing is inserted when the value already sits where a previous
+           insert of it at the same index would have left it.
+        '''
+        entry = self._list_entry(path)
         if not isinstance(entry, list):
-            return (False, self.yaml_dict)
+            return (False, self._doc)
+
+        # where list.insert would have put value in the list without it, an
+        # index past either end was not inserted at and is inserted again
+        previous = index if index >= 0 else len(entry) - 1 + index
+        if 0 <= previous < len(entry) and entry[previous] == value:
+            return (False, self._doc)
 
-        entry.insert(index, value)
-        return (True, self.yaml_dict)
+        self._journal().insert(entry, index, value)
+        return (True, self._doc)
 
     # pylint: disable=too-many-arguments
     def update(self, path, value, index=None, curr_value=None):
         ''' put path, value into a dict '''
+        self._expand(path, dirty=True)
         try:
-            entry = Yedit.get_entry(self.yaml_dict, path, self.separator)
+            entry = Yedit.get_entry(self._doc, path, self.separator)
         except KeyError:
             entry = None
 
@@ -635,8 +2768,12 @@ class Yedit:
                 raise YeditException('Cannot replace key, value entry in dict with non-dict type. ' +
                                      'value=[{0}] type=[{1}]'.format(value, type(value)))
 
-            entry.update(value)
-            return (True, self.yaml_dict)
+            undo = self._journal()
+            mark = len(undo)
+            for key, val in value.items():
+                if key not in entry or entry[key] != val:
+                    undo.set_item(entry, key, val)
+            return (len(undo) > mark, self._doc)
 
         elif isinstance(entry, list):
             # AUDIT:maybe-no-member makes sense due to fuzzy types
@@ -646,69 +2783,133 @@ class Yedit:
                 try:
                     ind = entry.index(curr_value)
                 except ValueError:
-                    return (False, self.yaml_dict)
+                    return (False, self._doc)
 
             elif index is not None:
                 ind = index
 
             if ind is not None and entry[ind] != value:
-                entry[ind] = value
-                return (True, self.yaml_dict)
+                self._journal().set_item(entry, ind, value)
+                return (True, self._doc)
 
             # see if it exists in the list
             try:
                 ind = entry.index(value)
             except ValueError:
                 # doesn't exist, append it
-                entry.append(value)
-                return (True, self.yaml_dict)
+                self._journal().set_item(entry, len(entry), value)
+                return (True, self._doc)
 
             # already exists, return
             if ind is not None:
-                return (False, self.yaml_dict)
-        return (False, self.yaml_dict)
+                return (False, self._doc)
+        return (False, self._doc)
 
     def put(self, path, value):
         ''' put path, value into a dict '''
-        try:
-            entry = Yedit.get_entry(self.yaml_dict, path, self.separator)
-        except KeyError:
-            entry = None
+        self._expand(path, dirty=True)
+        tokens = Yedit.key_tokens(path, self.separator)
+        if tokens is None:
+            return (False, self._doc)
+
+        # When path equals "" it is a special case.
+        # "" refers to the root of the document
+        # Only update the root path (entire document) when its a list or dict
+        if not tokens:
+            if self._doc == value:
+                return (False, self._doc)
+
+            return (self._replace_root(value), self._doc)
 
+        cursor = Yedit.cursor(self._doc, tokens)
+        entry = Yedit.cursor_get(*cursor) if cursor is not None else None
         if entry == value:
-            return (False, self.yaml_dict)
+            return (False, self._doc)
 
-        tmp_copy = copy.deepcopy(self.yaml_dict)
+        if cursor is not None and Yedit.cursor_settable(*cursor):
+            spliced = self._track_splice(cursor[0], cursor[1], value)
+            self._journal(structural=not spliced).set_item(*cursor, value)
+            return (True, self._doc)
 
-        result = Yedit.add_entry(tmp_copy, path, value, self.separator)
-        if result is None:
-            return (False, self.yaml_dict)
+        self._add(tokens, value, path)
 
-        # When path equals "" it is a special case.
-        # "" refers to the root of the document
-        # Only update the root path (entire document) when its a list or dict
-        if path == '':
-            if isinstance(result, list) or isinstance(result, dict):
-                self.yaml_dict = result
-                return (True, self.yaml_dict)
+        return (True, self._doc)
+
+    def begin(self):
+        ''' start a batch of edits that is committed or rolled back as a whole '''
+        if self._undo_log is not None:
+            raise YeditException('A batch of edits is already in progress.')
 
-            return (False, self.yaml_dict)
+        self._undo_log = YeditUndoLog()
 
-        self.yaml_dict = tmp_copy
+    def commit(self):
+        ''' keep every edit made since begin() '''
+        self._undo_log = None
 
-        return (True, self.yaml_dict)
+    def rollback(self):
+        ''' revert every edit made since begin() '''
+        if self._undo_log is not None:
+            self._undo_log.rollback()
+        self._undo_log = None
+
+    def _journal(self, structural=True):
+        ''' return the undo log of the running transaction or a fresh one for a single operation.
+
+            Unless told otherwise the change is structural, and the next write
+            has to dump the whole document.
+        '''
+        if structural:
+            self._structural = True
+
+        if self._undo_log is not None:
+            return self._undo_log
+
+        return YeditUndoLog()
+
+    def _replace_root(self, value):
+        ''' replace the whole document, only lists and dicts are accepted '''
+        if not isinstance(value, (list, dict)):
+            return False
+
+        self._journal().record(setattr, self, 'yaml_dict', self.yaml_dict)
+        self.yaml_dict = value
+        return True
+
+    def _add(self, tokens, value, path):
+        ''' create the path down to tokens and store value there.
+
+            Intermediate entries created on the way are rolled back when the
+            path turns out to be unusable, so a failure leaves the document as
+            it was.
+        '''
+        undo = self._journal()
+        mark = len(undo)
+        try:
+            parent, token = Yedit.cursor(self._doc, tokens, create=True, key=path, undo=undo)
+
+            # didn't add/update to an existing list, nor add/update key to a dict
+            # so we must have been provided some syntax like a.b.c[<int>] = "data" for a
+            # non-existent array
+            if not Yedit.cursor_settable(parent, token):
+                raise YeditException("Error adding to object at path: {0}".format(path))
+
+            undo.set_item(parent, token, value)
+        except YeditException:
+            undo.rollback(mark)
+            raise
 
     def create(self, path, value):
         ''' create a yaml file '''
         if not self.file_exists():
-            tmp_copy = copy.deepcopy(self.yaml_dict)
+            tokens = Yedit.key_tokens(path, self.separator)
+            if tokens:
+                self._add(tokens, value, path)
+                return (True, self._doc)
 
-            result = Yedit.add_entry(tmp_copy, path, value, self.separator)
-            if result is not None:
-                self.yaml_dict = tmp_copy
-                return (True, self.yaml_dict)
+            if tokens == () and self._replace_root(value):
+                return (True, self._doc)
 
-        return (False, self.yaml_dict)
+        return (False, self._doc)
 
     @staticmethod
     def get_curr_value(invalue, val_type):
@@ -755,51 +2956,208 @@ class Yedit:
 
     @staticmethod
     def process_edits(edits, yamlfile):
-        '''run through a list of edits and process them one-by-one'''
+        '''run through a list of edits and process them one-by-one.
+
+           The edits are applied as a single batch: when one of them fails
+           every edit already applied is rolled back before the error is raised.
+        '''
         results = []
-        for edit in edits:
-            value = Yedit.parse_value(edit['value'], edit.get('value_type', ''))
-            if edit.get('action') == 'update':
-                # pylint: disable=line-too-long
-                curr_value = Yedit.get_curr_value(
-                    Yedit.parse_value(edit.get('curr_value')),
-                    edit.get('curr_value_format'))
+        yamlfile.begin()
+        try:
+            for edit in edits:
+                value = Yedit.parse_value(edit['value'], edit.get('value_type', ''))
+                if edit.get('action') == 'update':
+                    # pylint: disable=line-too-long
+                    curr_value = Yedit.get_curr_value(
+                        Yedit.parse_value(edit.get('curr_value')),
+                        edit.get('curr_value_format'))
 
-                rval = yamlfile.update(edit['key'],
-                                       value,
-                                       edit.get('index'),
-                                       curr_value)
+                    rval = yamlfile.update(edit['key'],
+                                           value,
+                                           edit.get('index'),
+                                           curr_value)
 
-            elif edit.get('action') == 'append':
-                rval = yamlfile.append(edit['key'], value)
+                elif edit.get('action') == 'append':
+                    rval = yamlfile.append(edit['key'], value)
 
-            elif edit.get('action') == 'insert':
-                rval = yamlfile.insert(edit['key'], value, edit['index'])
+                elif edit.get('action') == 'insert':
+                    rval = yamlfile.insert(edit['key'], value, edit['index'])
 
-            else:
-                rval = yamlfile.put(edit['key'], value)
+                else:
+                    rval = yamlfile.put(edit['key'], value)
+
+                if rval[0]:
+                    results.append({'key': edit['key'], 'edit': rval[1]})
+        except BaseException:
+            # not only YeditException: a missing index or an index out of range
+            # must not leave the document half edited with the batch still open
+            yamlfile.rollback()
+            raise
 
-            if rval[0]:
-                results.append({'key': edit['key'], 'edit': rval[1]})
+        yamlfile.commit()
 
         return {'changed': len(results) > 0, 'results': results}
 
-    # pylint: disable=too-many-return-statements,too-many-branches
+    @staticmethod
+    def params_edits(params):
+        '''the edits to process for the module parameters'''
+        # If we were passed a key, value then
+        # we enapsulate it in a list and process it
+        # Key, Value passed to the module : Converted to Edits list #
+        edits = []
+        _edit = {}
+        if params['value'] is not None:
+            _edit['value'] = params['value']
+            _edit['value_type'] = params['value_type']
+            _edit['key'] = params['key']
+
+            if params['update']:
+                _edit['action'] = 'update'
+                _edit['curr_value'] = params['curr_value']
+                _edit['curr_value_format'] = params['curr_value_format']
+                _edit['index'] = params['index']
+
+            elif params['append']:
+                _edit['action'] = 'append'
+
+            elif params['insert']:
+                _edit['action'] = 'insert'
+                _edit['index'] = params['index']
+
+            edits.append(_edit)
+
+        elif params['edits'] is not None:
+            edits = params['edits']
+
+        return edits
+
+    @staticmethod
+    def run_stream(yamlfile, params):
+        '''perform the edits of run_ansible with the streaming engine'''
+        state = params['state']
+        if params['content'] or params['content_type'] != 'yaml':
+            return {'failed': True,
+                    'msg': 'The stream engine only edits yaml files given by src, without content.'}
+
+        if state == 'absent':
+            if params['update'] or params['index'] is not None or params['value'] is not None:
+                return {'failed': True, 'msg': 'The stream engine can only remove a key.'}
+            edits = [{'action': 'delete', 'key': params['key']}]
+        else:
+            edits = Yedit.params_edits(params)
+
+        changed, keys = yamlfile.stream_edits(edits)
+        return {'changed': changed, 'result': [{'key': key} for key in keys], 'state': state}
+
     @staticmethod
     def run_ansible(params):
         '''perform the idempotent crud operations'''
-        yamlfile = Yedit(filename=params['src'],
-                         backup=params['backup'],
-                         content_type=params['content_type'],
-                         backup_ext=params['backup_ext'],
-                         separator=params['separator'])
+        backup_store = None
+        if params.get('backup_store'):
+            max_age = params.get('backup_max_age')
+            backup_store = YeditBackupStore(params['backup_store'],
+                                            compression=params.get('backup_compression', 'gzip'),
+                                            max_count=params.get('backup_keep'),
+                                            max_age=max_age * 86400 if max_age is not None else None,
+                                            max_bytes=params.get('backup_max_bytes'),
+                                            delta=params.get('backup_delta', False))
+
+        # edits that were found to change nothing in these exact contents before need no parsing
+        fingerprint = None
+        if params.get('fingerprint') and params['src'] and params['state'] == 'present' and \
+           not params['content'] and params.get('backup_restore') is None and os.path.isfile(params['src']):
+            edits = Yedit.params_edits(params)
+            # appends change the file every time
+            if edits and all(edit.get('action') != 'append' for edit in edits):
+                fingerprint = (Yedit.file_hash(params['src']), Yedit.edits_digest(params, edits))
+                known = Yedit.read_fingerprint(params['src'])
+                if known is not None and known[0] == fingerprint[0] and fingerprint[1] in known[1]:
+                    results = {'changed': False, 'result': [], 'state': params['state']}
+                    if params.get('debug'):
+                        results['debug'] = {'fingerprint': 'hit'}
+                    return results
+
+        optimistic = params.get('optimistic', False)
+        retries = params.get('optimistic_retries', 3) if optimistic else 0
+        conflicts = 0
+        while True:
+            yamlfile = Yedit(filename=params['src'],
+                             backup=params['backup'],
+                             content_type=params['content_type'],
+                             backup_ext=params['backup_ext'],
+                             separator=params['separator'],
+                             read_only=params['state'] == 'list',
+                             splice=True,
+                             sparse=params.get('sparse', False),
+                             document=params.get('document'),
+                             durability=params.get('durability', 'full'),
+                             backup_store=backup_store,
+                             optimistic=optimistic)
+
+            if params.get('lock') and params['src']:
+                try:
+                    yamlfile.acquire_lock(shared=params['state'] == 'list', timeout=params.get('lock_timeout'))
+                except YeditException as err:
+                    return {'failed': True, 'msg': str(err)}
+
+            try:
+                results = Yedit._run_ansible(yamlfile, params)
+                break
+            except YeditConflict as err:
+                # start over from the file as it is now, applying the same edits again
+                if conflicts == retries:
+                    return {'failed': True, 'msg': '{0} Gave up after {1} retries.'.format(err, retries)}
+                conflicts += 1
+                time.sleep(0.05 * 2 ** conflicts * (0.5 + random.random()))
+            finally:
+                yamlfile.release_lock()
+
+        yamlfile.debug_info['conflicts'] = conflicts
+        if fingerprint is not None and not results.get('changed') and not results.get('failed') and \
+           Yedit.file_hash(params['src']) == fingerprint[0]:
+            Yedit.record_fingerprint(params['src'], *fingerprint)
+            yamlfile.debug_info['fingerprint'] = 'recorded'
+
+        if params.get('debug'):
+            results['debug'] = yamlfile.debug_info
+
+        return results
 
+    # pylint: disable=too-many-return-statements,too-many-branches
+    @staticmethod
+    def _run_ansible(yamlfile, params):
+        '''perform the idempotent crud operations on yamlfile'''
         state = params['state']
 
-        if params['src']:
+        if params.get('backup_restore') is not None:
+            if yamlfile.backup_store is None or not params['src']:
+                return {'failed': True, 'msg': 'backup_restore needs backup_store and src.'}
+            try:
+                changed, entry = yamlfile.restore_backup(params['backup_restore'])
+            except YeditConflict:
+                raise
+            except YeditException as err:
+                return {'failed': True, 'msg': str(err)}
+            return {'changed': changed, 'result': entry, 'state': state}
+
+        # huge files can be edited on the fly without loading them, a missing file is created in memory
+        if params.get('engine') == 'stream' and state != 'list' and params['src'] and yamlfile.file_exists() and \
+           params.get('document') is None:
+            return Yedit.run_stream(yamlfile, params)
+
+        rval = None
+        # a single key can be read from the parse events, stopping as soon as it is found
+        if state == 'list' and params['src'] and params['key'] and not params['content']:
+            found, rval = yamlfile.stream_lookup(params['key'])
+            if found:
+                return {'changed': False, 'result': rval, 'state': state}
+
+        # content replaces the document for list and absent, so the file is not needed.
+        # present loads it on first use, which an append at the end of the file can avoid.
+        if params['src'] and state != 'present' and not (params['content'] and state in ('list', 'absent')):
             rval = yamlfile.load()
 
-            if yamlfile.yaml_dict is None and state != 'present':
+            if yamlfile._doc is None and state != 'present':
                 return {'failed': True,
                         'msg': 'Error opening file [{0}].  Verify that the '.format(params['src']) +
                                'file exists, that it is has correct permissions, and is valid yaml.'}
@@ -811,6 +3169,8 @@ class Yedit:
 
             if params['key']:
                 rval = yamlfile.get(params['key'])
+            else:
+                rval = yamlfile.yaml_dict
 
             return {'changed': False, 'result': rval, 'state': state}
 
@@ -824,62 +3184,45 @@ class Yedit:
             else:
                 rval = yamlfile.delete(params['key'], params['index'], params['value'])
 
-            if rval[0] and params['src']:
-                yamlfile.write()
+            changed = rval[0]
+            if changed and params['src']:
+                changed = yamlfile.write()[0]
 
-            return {'changed': rval[0], 'result': rval[1], 'state': state}
+            return {'changed': changed, 'result': rval[1], 'state': state}
 
         elif state == 'present':
             # check if content is different than what is in the file
+            content_changed = False
             if params['content']:
                 content = Yedit.parse_value(params['content'], params['content_type'])
+                content_changed = yamlfile.yaml_dict != content
 
                 # We had no edits to make and the contents are the same
-                if yamlfile.yaml_dict == content and \
-                   params['value'] is None:
+                if not content_changed and params['value'] is None and not params.get('edits'):
                     return {'changed': False, 'result': yamlfile.yaml_dict, 'state': state}
 
                 yamlfile.yaml_dict = content
 
-            # If we were passed a key, value then
-            # we enapsulate it in a list and process it
-            # Key, Value passed to the module : Converted to Edits list #
-            edits = []
-            _edit = {}
-            if params['value'] is not None:
-                _edit['value'] = params['value']
-                _edit['value_type'] = params['value_type']
-                _edit['key'] = params['key']
-
-                if params['update']:
-                    _edit['action'] = 'update'
-                    _edit['curr_value'] = params['curr_value']
-                    _edit['curr_value_format'] = params['curr_value_format']
-                    _edit['index'] = params['index']
-
-                elif params['append']:
-                    _edit['action'] = 'append'
-
-                elif params['insert']:
-                    _edit['action'] = 'insert'
-                    _edit['index'] = params['index']
-
-                edits.append(_edit)
+            edits = Yedit.params_edits(params)
 
-            elif params['edits'] is not None:
-                edits = params['edits']
+            # appending to a list at the end of the file only writes the new item
+            if len(edits) == 1 and edits[0].get('action') == 'append' and params['src'] and not params['content']:
+                value = Yedit.parse_value(edits[0]['value'], edits[0].get('value_type', ''))
+                if yamlfile.append_in_place(edits[0]['key'], value):
+                    return {'changed': True, 'result': [{'key': edits[0]['key']}], 'state': state}
 
             if edits:
                 results = Yedit.process_edits(edits, yamlfile)
+                changed = results['changed'] or content_changed
 
                 # if there were changes and a src provided to us we need to write
-                if results['changed'] and params['src']:
-                    yamlfile.write()
+                if changed and params['src']:
+                    changed = yamlfile.write()[0]
 
-                return {'changed': results['changed'], 'result': results['results'], 'state': state}
+                return {'changed': changed, 'result': results['results'], 'state': state}
 
-            # no edits to make
-            if params['src']:
+            # no edits to make, only write when the content was replaced or the file is missing
+            if params['src'] and (content_changed or not yamlfile.file_exists()):
                 rval = yamlfile.write()
                 return {'changed': rval[0],
                         'result': rval[1],
@@ -923,6 +3266,22 @@ def main():
             backup_ext=dict(default=".{0}".format(time.strftime("%Y%m%dT%H%M%S")), type='str'),
             separator=dict(default='.', type='str'),
             edits=dict(default=None, type='list'),
+            sparse=dict(default=False, type='bool'),
+            engine=dict(default='memory', choices=['memory', 'stream'], type='str'),
+            document=dict(default=None, type='str'),
+            durability=dict(default='full', choices=['full', 'data-only', 'none'], type='str'),
+            lock=dict(default=False, type='bool'),
+            lock_timeout=dict(default=30, type='float'),
+            backup_store=dict(default=None, type='path'),
+            backup_compression=dict(default='gzip', choices=['gzip', 'lzma'], type='str'),
+            backup_keep=dict(default=None, type='int'),
+            backup_max_age=dict(default=None, type='float'),
+            backup_max_bytes=dict(default=None, type='int'),
+            backup_delta=dict(default=False, type='bool'),
+            backup_restore=dict(default=None, type='int'),
+            optimistic=dict(default=False, type='bool'),
+            optimistic_retries=dict(default=3, type='int'),
+            fingerprint=dict(default=False, type='bool'),
         ),
         mutually_exclusive=[["curr_value", "index"], ['update', "append"]],
         required_one_of=[["content", "src"]],
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+'''
+ Microbenchmark of the legacy regex key parser against Yedit.compile_key
+
+ Run from the repository root:
+   python tests/benchmarks/bench_key_parser.py
+'''
+
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '../../plugins/modules'))
+
+from yedit import Yedit  # noqa: E402
+
+KEYS = [
+    'metadata.namespace',
+    'spec.containers[0].volumeMounts[1].readOnly',
+    'spec.template.spec.containers[0].env[3].valueFrom.secretKeyRef.name',
+]
+NUMBER = 100000
+
+
+def legacy_parse(key, sep='.'):
+    '''validate, tokenize and convert a key the way Yedit did before compile_key'''
+    common_separators = list(Yedit.com_sep - set([sep]))
+    if not re.match(Yedit.re_valid_key.format(''.join(common_separators)), key):
+        return None
+    tokens = re.findall(Yedit.re_key.format(''.join(common_separators)), key)
+    return tuple(int(arr_ind) if arr_ind else dict_key for arr_ind, dict_key in tokens)
+
+
+def uncached_compile(key, sep='.'):
+    '''the single pass tokenizer without the memoization layer'''
+    return Yedit.compile_key.__wrapped__(key, sep)
+
+
+def main():
+    ''' run the benchmark '''
+    for key in KEYS:
+        assert legacy_parse(key) == Yedit.compile_key(key)
+        print(key)
+        for name, func in [('legacy regex', legacy_parse),
+                           ('tokenizer', uncached_compile),
+                           ('tokenizer+cache', Yedit.compile_key)]:
+            elapsed = timeit.timeit(lambda: func(key), number=NUMBER)
+            print('  {0:<16} {1:8.3f} us/key'.format(name, elapsed / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
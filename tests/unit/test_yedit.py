@@ -2,8 +2,12 @@
  Unit tests for yedit
 '''
 
+import io
 import os
+import shutil
 import sys
+import tempfile
+import time
 import unittest
 import mock
 
@@ -16,7 +20,7 @@ import mock
 yedit_path = os.path.join(os.path.realpath('.'), '../../library')  # noqa: E501
 sys.path.insert(0, yedit_path)
 
-from yedit import Yedit, YeditException  # noqa: E402
+from yedit import Yedit, YeditBackupStore, YeditConflict, YeditException, YeditPath, YeditUndoLog  # noqa: E402
 
 # pylint: disable=too-many-public-methods
 # Silly pylint, moar tests!
@@ -324,6 +328,776 @@ class YeditTest(unittest.TestCase):
         with self.assertRaises(YeditException):
             Yedit.parse_value('TTT', 'bool')
 
+    def test_compile_key(self):
+        '''test compiling keys into tokens'''
+        self.assertEqual(Yedit.compile_key('a.b[0].c'), ('a', 'b', 0, 'c'))
+        self.assertEqual(Yedit.compile_key('a#b.c', '#'), ('a', 'b.c'))
+        self.assertEqual(Yedit.compile_key('a[-1]'), ('a', -1))
+        self.assertEqual(Yedit.compile_key(''), ())
+        self.assertIsNone(Yedit.compile_key('a..b'))
+        self.assertIsNone(Yedit.compile_key('.a'))
+
+    def test_compile_key_matches_parse_key(self):
+        '''test the tokenizer agrees with the regex based parser'''
+        for key in ['spec.containers[0].volumeMounts[1].readOnly', 'a-b/c_d.e', '[0][1].x', 'a.b.']:
+            expected = tuple(int(ind) if ind else name for ind, name in Yedit.parse_key(key))
+            self.assertTrue(Yedit.valid_key(key))
+            self.assertEqual(Yedit.compile_key(key), expected)
+
+    def test_compile_key_is_memoized(self):
+        '''test that repeated keys are served from the key cache'''
+        Yedit.compile_key.cache_clear()
+        yed = Yedit(content={'a': {'b': 1}})
+        yed.get('a.b')
+        yed.get('a.b')
+        info = Yedit.compile_key.cache_info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 1)
+
+    def test_compiled_path(self):
+        '''test passing a YeditPath in place of a string key'''
+        path = YeditPath('b:c:d', ':')
+        yed = Yedit("yedit_test.yml", separator=':')
+        self.assertEqual(yed.get(path), [{'e': 'x'}, 'f', 'g'])
+        self.assertTrue(yed.exists(path, 'f'))
+        yed.append(path, 'h')
+        yed.insert(path, 'i', 0)
+        yed.pop(path, 'f')
+        self.assertEqual(yed.get('b:c:d'), ['i', {'e': 'x'}, 'g', 'h'])
+        yed.put(YeditPath('b:c:d[0]', ':'), 'j')
+        yed.delete(YeditPath('b:c:d[1]', ':'))
+        self.assertEqual(yed.get(path), ['j', 'g', 'h'])
+        yed.update(path, 'k', index=0)
+        self.assertEqual(yed.get(path), ['k', 'g', 'h'])
+
+    def test_compiled_path_invalid(self):
+        '''test that invalid keys are rejected when compiling'''
+        with self.assertRaises(YeditException):
+            YeditPath('a..b')
+
+    def test_cursor(self):
+        '''test resolving a path to its parent container'''
+        data = {'a': {'b': [{'c': 1}]}}
+        parent, token = Yedit.cursor(data, Yedit.compile_key('a.b[0].c'))
+        self.assertIs(parent, data['a']['b'][0])
+        self.assertEqual(token, 'c')
+        self.assertEqual(Yedit.cursor_get(parent, token), 1)
+        self.assertIsNone(Yedit.cursor(data, Yedit.compile_key('a.x.y')))
+
+    def test_put_existing_parent_in_place(self):
+        '''test that put on an existing parent mutates it in place'''
+        yed = Yedit("yedit_test.yml")
+        parent = yed.get('b.c')
+        yed.put('b.c.x', 'y')
+        self.assertIs(yed.get('b.c'), parent)
+        self.assertEqual(parent['x'], 'y')
+
+    def test_failed_put_rolls_back(self):
+        '''test that a put failing part way leaves the document untouched'''
+        yed = Yedit(content={'a': {'b': 12}})
+        with self.assertRaises(YeditException):
+            yed.put('a.new.stuff[0]', 'value')
+        self.assertEqual(yed.yaml_dict, {'a': {'b': 12}})
+
+    def test_undo_log_rollback(self):
+        '''test reverting recorded operations'''
+        data = {'a': 1, 'b': [1, 2, 3], 'c': 3}
+        undo = YeditUndoLog()
+        undo.set_item(data, 'a', 2)
+        undo.set_item(data, 'd', 4)
+        undo.del_item(data, 'b')
+        undo.del_item(data, 'c')
+        undo.rollback()
+        self.assertEqual(list(data.items()), [('a', 1), ('b', [1, 2, 3]), ('c', 3)])
+
+        items = data['b']
+        undo.set_item(items, 3, 4)
+        undo.insert(items, -1, 5)
+        undo.del_item(items, -1)
+        undo.clear(items)
+        undo.rollback()
+        self.assertEqual(items, [1, 2, 3])
+
+    def test_process_edits_is_atomic(self):
+        '''test that a failing edit rolls back the whole batch'''
+        yed = Yedit(content={'a': {'b': [1, 2]}, 'c': 'd'})
+        edits = [{'key': 'c', 'value': 'e'},
+                 {'key': 'a.b', 'value': 3, 'action': 'append'},
+                 {'key': 'a.b', 'value': 0, 'action': 'insert', 'index': 0},
+                 {'key': 'a', 'value': {'x': 1}, 'action': 'update'},
+                 {'key': 'new.stuff[0]', 'value': 'boom'}]
+        with self.assertRaises(YeditException):
+            Yedit.process_edits(edits, yed)
+        self.assertEqual(yed.yaml_dict, {'a': {'b': [1, 2]}, 'c': 'd'})
+
+        results = Yedit.process_edits(edits[:-1], yed)
+        self.assertTrue(results['changed'])
+        self.assertEqual(yed.yaml_dict, {'a': {'b': [0, 1, 2, 3], 'x': 1}, 'c': 'e'})
+
+    def test_process_edits_rolls_back_on_any_error(self):
+        '''test that errors other than YeditException roll back and close the batch'''
+        yed = Yedit(content={'a': [1, 2], 'c': 'd'})
+        with self.assertRaises(KeyError):
+            Yedit.process_edits([{'key': 'c', 'value': 'e'},
+                                 {'key': 'a', 'value': 0, 'action': 'insert'}], yed)
+        self.assertEqual(yed.yaml_dict, {'a': [1, 2], 'c': 'd'})
+
+        with self.assertRaises(IndexError):
+            Yedit.process_edits([{'key': 'c', 'value': 'e'},
+                                 {'key': 'a', 'value': 3, 'action': 'update', 'index': 9}], yed)
+        self.assertEqual(yed.yaml_dict, {'a': [1, 2], 'c': 'd'})
+
+        self.assertTrue(Yedit.process_edits([{'key': 'c', 'value': 'e'}], yed)['changed'])
+        self.assertEqual(yed.yaml_dict, {'a': [1, 2], 'c': 'e'})
+
+    def test_update_dict_no_change(self):
+        '''test that updating a dict with values it already has is a no-op'''
+        yed = Yedit(content={'a': {'b': 1, 'c': 2}})
+        self.assertFalse(yed.update('a', {'b': 1})[0])
+        self.assertTrue(yed.update('a', {'b': 1, 'd': 3})[0])
+
+    def test_insert_twice_is_idempotent(self):
+        '''test that repeating an insert does not insert again'''
+        yed = Yedit(content={'a': [1, 2, 3]})
+        self.assertTrue(yed.insert('a', 0, 0)[0])
+        self.assertFalse(yed.insert('a', 0, 0)[0])
+        self.assertTrue(yed.insert('a', 9, -1)[0])
+        self.assertFalse(yed.insert('a', 9, -1)[0])
+        self.assertEqual(yed.get('a'), [0, 1, 2, 9, 3])
+
+    def test_insert_past_the_ends(self):
+        '''test that an insert at or past either end of the list is not taken as done'''
+        yed = Yedit(content={'a': [1, 2, 3]})
+        self.assertTrue(yed.insert('a', 3, 3)[0])
+        self.assertEqual(yed.get('a'), [1, 2, 3, 3])
+        self.assertTrue(yed.insert('a', 1, -9)[0])
+        self.assertEqual(yed.get('a'), [1, 1, 2, 3, 3])
+        self.assertTrue(yed.insert('a', 5, -2)[0])
+        self.assertFalse(yed.insert('a', 5, -2)[0])
+        self.assertEqual(yed.get('a'), [1, 1, 2, 5, 3, 3])
+
+    def test_delete_missing_root_key(self):
+        '''test that removing a missing key from a dict root raises KeyError'''
+        yed = Yedit(content={'a': 1})
+        self.assertRaises(KeyError, yed.delete, '', value='b')
+        self.assertEqual(yed.yaml_dict, {'a': 1})
+        self.assertTrue(yed.delete('', value='a')[0])
+        self.assertEqual(yed.yaml_dict, {})
+
+    @mock.patch('yedit.Yedit.write')
+    def test_run_ansible_src_without_edits(self, mock_write):
+        '''test that an existing src without content or edits is not rewritten'''
+        params = {
+            'src': YeditTest.filename,
+            'backup': False,
+            'backup_ext': '',
+            'separator': '.',
+            'state': 'present',
+            'edits': None,
+            'value': None,
+            'key': None,
+            'content': None,
+            'content_type': 'yaml',
+        }
+
+        results = Yedit.run_ansible(params)
+
+        self.assertFalse(results['changed'])
+        self.assertFalse(mock_write.called)
+
+    def test_write_skipped_when_identical(self):
+        '''test that a document serializing to the file contents is not written'''
+        yed = Yedit(YeditTest.filename)
+        yed.put('a', 'changed')
+        yed.put('a', 'a')
+        with mock.patch('yedit.Yedit._write') as mock_write:
+            self.assertFalse(yed.write()[0])
+            self.assertFalse(mock_write.called)
+
+            yed.put('a', 'changed')
+            self.assertTrue(yed.write()[0])
+            self.assertTrue(mock_write.called)
+
+    def test_load_is_cached(self):
+        '''test that loading an unchanged file does not parse it again'''
+        yed = Yedit(YeditTest.filename)
+        yed.put('a', 'changed')
+        with mock.patch('yedit.Yedit.read') as mock_read:
+            yed.load()
+            self.assertFalse(mock_read.called)
+        self.assertEqual(yed.get('a'), 'changed')
+
+        yed.load(reload=True)
+        self.assertEqual(yed.get('a'), 'a')
+
+    def test_lazy_load(self):
+        '''test that the file is only parsed when the document is accessed'''
+        with mock.patch('yedit.Yedit.read') as mock_read:
+            yed = Yedit(YeditTest.filename)
+            yed.yaml_dict = {'z': 1}
+            self.assertFalse(mock_read.called)
+        self.assertEqual(yed.get('z'), 1)
+
+        yed = Yedit(YeditTest.filename)
+        self.assertEqual(yed.get('a'), 'a')
+
+    def test_read_only_load(self):
+        '''test that read-only documents are loaded with the safe loader'''
+        yed = Yedit(YeditTest.filename, read_only=True)
+        self.assertEqual(yed.yaml_dict, self.data)
+        self.assertIs(type(yed.yaml_dict), dict)
+        self.assertEqual(yed.get('b.c.d[0].e'), 'x')
+        with self.assertRaises(YeditException):
+            yed.write()
+
+    def test_stream_lookup(self):
+        '''test reading keys from the parse events without loading the document'''
+        for key in ['a', 'b.c.d', 'b.c.d[0].e', 'b.c.d[2]', 'b.c.x', 'b.c.d[5]', 'a.b']:
+            yed = Yedit(YeditTest.filename)
+            found, value = yed.stream_lookup(key)
+            self.assertTrue(found)
+            self.assertEqual(value, Yedit(YeditTest.filename).get(key))
+
+    def test_stream_get_needs_full_load(self):
+        '''test that aliases are left to a full load'''
+        stream = io.StringIO('a: &x {b: 1}\nc: *x\n')
+        self.assertEqual(Yedit.stream_get(stream, ('c', 'b')), (False, None))
+
+    def test_run_ansible_list_streams(self):
+        '''test that state=list with a key does not load the document'''
+        params = {
+            'src': YeditTest.filename,
+            'backup': False,
+            'backup_ext': '',
+            'separator': '.',
+            'state': 'list',
+            'key': 'b.c.d[1]',
+            'content': None,
+            'content_type': 'yaml',
+        }
+
+        with mock.patch('yedit.Yedit.load') as mock_load:
+            results = Yedit.run_ansible(params)
+            self.assertFalse(mock_load.called)
+
+        self.assertEqual(results['result'], 'f')
+
+    def test_splice_write(self):
+        '''test that changing scalars only rewrites their text'''
+        with open(YeditTest.filename, 'w') as yfd:
+            yfd.write('a:   spaced    # comment\nb: {c: 1}\nd:\n-   x\n')
+        yed = Yedit(YeditTest.filename, splice=True)
+        yed.put('a', 'new value')
+        yed.put('d[0]', 12)
+        with mock.patch('yedit.Yedit.dumps') as mock_dumps:
+            yed.write()
+            self.assertFalse(mock_dumps.called)
+        with open(YeditTest.filename) as yfd:
+            self.assertEqual(yfd.read(), 'a:   new value    # comment\nb: {c: 1}\nd:\n-   12\n')
+
+    def test_splice_write_falls_back(self):
+        '''test that changes which cannot be spliced dump the whole document'''
+        with open(YeditTest.filename, 'w') as yfd:
+            yfd.write('a: 1\nb: {c: 1}\n')
+        yed = Yedit(YeditTest.filename, splice=True)
+        yed.put('b.c', 2)
+        self.assertIsNone(yed._splice_contents())
+        yed.put('e', 3)
+        yed.write()
+        self.assertEqual(Yedit(YeditTest.filename).yaml_dict, {'a': 1, 'b': {'c': 2}, 'e': 3})
+
+    def test_split_sections(self):
+        '''test splitting a document into its top level sections'''
+        self.assertEqual(Yedit.split_sections('# head\na: 1\nb:\n  c: [1,\n 2]\n"d e": x\n'),
+                         [('a', '# head\na: 1\n'), ('b', 'b:\n  c: [1,\n 2]\n'), ('d e', '"d e": x\n')])
+        self.assertIsNone(Yedit.split_sections('- a\n- b\n'))
+        self.assertIsNone(Yedit.split_sections('a: &x 1\nb: *x\n'))
+        self.assertIsNone(Yedit.split_sections('1: a\nb: c\n'))
+        self.assertIsNone(Yedit.split_sections('a: 1\n---\nb: 2\n'))
+
+    def test_sparse_edit(self):
+        '''test that a sparse document only parses and rewrites the sections that are edited'''
+        with open(YeditTest.filename, 'w') as yfd:
+            yfd.write('a:   {b:   1}   # keep\nc:\n  d: 1\ne:    [1,   2]\n')
+        yed = Yedit(YeditTest.filename, sparse=True)
+        self.assertTrue(yed.put('c.d', 2)[0])
+        self.assertTrue(yed.put('f', 3)[0])
+        self.assertEqual(list(yed._doc), ['c', 'f'])
+        yed.write()
+        with open(YeditTest.filename) as yfd:
+            self.assertEqual(yfd.read(), 'a:   {b:   1}   # keep\nc:\n  d: 2\ne:    [1,   2]\nf: 3\n')
+
+        yed = Yedit(YeditTest.filename, sparse=True)
+        self.assertEqual(yed.get('e[1]'), 2)
+        self.assertEqual(yed.yaml_dict, {'a': {'b': 1}, 'c': {'d': 2}, 'e': [1, 2], 'f': 3})
+
+    def test_sparse_delete_first_key(self):
+        '''test that deleting the first section keeps the comments leading the file'''
+        with open(YeditTest.filename, 'w') as yfd:
+            yfd.write('# head\n---\n# more\na: 1\nb: 2\n')
+        yed = Yedit(YeditTest.filename, sparse=True)
+        self.assertTrue(yed.delete('a')[0])
+        yed.write()
+        with open(YeditTest.filename) as yfd:
+            self.assertEqual(yfd.read(), '# head\n---\n# more\nb: 2\n')
+
+    def test_durability(self):
+        '''test that durability controls the file and directory syncs'''
+        for durability, syncs in (('full', 2), ('data-only', 1), ('none', 0)):
+            yed = Yedit(YeditTest.filename, durability=durability)
+            yed.put('a', durability)
+            with mock.patch('os.fsync') as mock_fsync, mock.patch('os.fdatasync', create=True) as mock_fdatasync:
+                yed.write()
+                self.assertEqual(mock_fsync.call_count + mock_fdatasync.call_count, syncs)
+            self.assertEqual(yed.debug_info['durability'], durability)
+            self.assertEqual('fsync_time' in yed.debug_info, syncs > 0)
+
+        self.assertRaises(YeditException, Yedit, YeditTest.filename, durability='sometimes')
+
+    def test_write_tmp_file(self):
+        '''test that writes keep the mode and leave no temp files behind'''
+        os.chmod(YeditTest.filename, 0o640)
+        directory = os.path.dirname(os.path.abspath(YeditTest.filename))
+        before = set(os.listdir(directory))
+        for patch in (mock.patch('os.link', side_effect=OSError), mock.patch('os.O_TMPFILE', 0, create=True)):
+            yed = Yedit(YeditTest.filename)
+            yed.put('a', str(patch))
+            with patch:
+                yed.write()
+            self.assertEqual(Yedit(YeditTest.filename).get('a'), str(patch))
+            self.assertEqual(os.stat(YeditTest.filename).st_mode & 0o777, 0o640)
+            self.assertEqual(set(os.listdir(directory)), before)
+
+    def test_copy_file(self):
+        '''test that every copy method makes the same backup'''
+        backup = YeditTest.filename + '.orig'
+        os.chmod(YeditTest.filename, 0o640)
+        with open(YeditTest.filename) as yfd:
+            contents = yfd.read()
+        no_reflink = mock.patch('fcntl.ioctl', side_effect=OSError)
+        no_copy_file_range = mock.patch('os.copy_file_range', side_effect=OSError, create=True)
+        try:
+            for patches, methods in (((), ('reflink', 'copy_file_range', 'copy')),
+                                     ((no_reflink,), ('copy_file_range', 'copy')),
+                                     ((no_reflink, no_copy_file_range), ('copy',))):
+                for patch in patches:
+                    patch.start()
+                try:
+                    self.assertIn(Yedit.copy_file(YeditTest.filename, backup), methods)
+                finally:
+                    for patch in patches:
+                        patch.stop()
+                with open(backup) as yfd:
+                    self.assertEqual(yfd.read(), contents)
+                self.assertEqual(os.stat(backup).st_mode & 0o777, 0o640)
+        finally:
+            os.unlink(backup)
+
+    def test_backup_store(self):
+        '''test that the backup store keeps contents once and prunes old backups'''
+        store_dir = tempfile.mkdtemp()
+        try:
+            store = YeditBackupStore(store_dir, max_count=2)
+            for value in ('one', 'two', 'one', 'three'):
+                yed = Yedit(YeditTest.filename, backup=True, backup_store=store)
+                yed.put('a', value)
+                yed.write()
+                self.assertEqual(yed.debug_info['backup_method'], 'store')
+            self.assertEqual(store.add(YeditTest.filename), store.backups(YeditTest.filename)[-1])
+
+            backups = store.backups(YeditTest.filename)
+            self.assertEqual(len(backups), 2)
+            self.assertFalse([name for name in os.listdir('.') if name.startswith(YeditTest.filename + '.')])
+
+            with mock.patch('yedit.YeditBackupStore.gc_grace', -1):
+                self.assertEqual(store.collect(), 2)
+            objects = [name for _, _, names in os.walk(os.path.join(store_dir, 'objects')) for name in names]
+            self.assertEqual(sorted(objects), sorted(entry['hash'] + '.gz' for entry in backups))
+
+            store.restore(YeditTest.filename, 0)
+            self.assertEqual(Yedit(YeditTest.filename).get('a'), 'one')
+        finally:
+            shutil.rmtree(store_dir)
+
+    def test_backup_store_shared(self):
+        '''test that backups only collect their own objects, and not those other files still use'''
+        store_dir = tempfile.mkdtemp()
+        other = YeditTest.filename + '.other'
+        try:
+            store = YeditBackupStore(store_dir, max_count=1)
+            shutil.copy(YeditTest.filename, other)
+            with mock.patch('yedit.YeditBackupStore.gc_grace', -1), \
+                    mock.patch('yedit.YeditBackupStore.collect') as mock_collect:
+                shared = store.add(YeditTest.filename)
+                store.add(other)
+                with open(YeditTest.filename, 'a') as yfd:
+                    yfd.write('new: 1\n')
+                store.add(YeditTest.filename)
+                self.assertFalse(mock_collect.called)
+
+                # the contents both files had stay for the other one
+                self.assertEqual([entry['hash'] for entry in store.backups(other)], [shared['hash']])
+                with open(other) as yfd:
+                    self.assertEqual(store.contents(other), yfd.read())
+
+                with open(other, 'a') as yfd:
+                    yfd.write('other: 1\n')
+                store.add(other)
+            objects = [name for _, _, names in os.walk(os.path.join(store_dir, 'objects')) for name in names]
+            self.assertEqual(len(objects), 2)
+            self.assertNotIn(shared['hash'] + '.gz', objects)
+        finally:
+            shutil.rmtree(store_dir)
+            os.unlink(other)
+
+    def test_backup_store_processes(self):
+        '''test that backups of the same file in parallel processes all make it into the index'''
+        store_dir = tempfile.mkdtemp()
+        try:
+            store = YeditBackupStore(store_dir)
+            pids = []
+            for number in range(8):
+                pid = os.fork()
+                if pid == 0:
+                    copy = '{0}.{1}'.format(YeditTest.filename, number)
+                    for version in range(5):
+                        with open(copy, 'w') as yfd:
+                            yfd.write('p{0}: {1}\n'.format(number, version))
+                        # every process backs up the same file name with its own contents
+                        with mock.patch('os.path.realpath', lambda path: 'shared.yml'):
+                            store.add(copy)
+                    os.unlink(copy)
+                    os._exit(0)
+                pids.append(pid)
+            self.assertEqual([os.waitpid(pid, 0)[1] for pid in pids], [0] * 8)
+
+            with mock.patch('os.path.realpath', lambda path: 'shared.yml'):
+                self.assertEqual(len(store.backups(YeditTest.filename)), 40)
+        finally:
+            shutil.rmtree(store_dir)
+
+    def test_backup_store_delta(self):
+        '''test that delta backups restore every version of the file'''
+        store_dir = tempfile.mkdtemp()
+        try:
+            store = YeditBackupStore(store_dir, delta=True)
+            versions = []
+            for number in range(20):
+                with open(YeditTest.filename) as yfd:
+                    versions.append(yfd.read())
+                yed = Yedit(YeditTest.filename, backup=True, backup_store=store)
+                yed.put('b.c.d[{0}]'.format(number % 3), number)
+                yed.put('x{0}'.format(number % 5), [number] * number)
+                yed.write()
+
+            backups = store.backups(YeditTest.filename)
+            self.assertEqual(['delta' in entry for entry in backups], [True] * 19 + [False])
+            for position, version in enumerate(versions):
+                self.assertEqual(store.contents(YeditTest.filename, position), version)
+
+            store.restore(YeditTest.filename, 3)
+            with open(YeditTest.filename) as yfd:
+                self.assertEqual(yfd.read(), versions[3])
+        finally:
+            shutil.rmtree(store_dir)
+
+    def test_backup_store_delta_large(self):
+        '''test that a small edit of a large file is stored as a small delta'''
+        store_dir = tempfile.mkdtemp()
+        try:
+            store = YeditBackupStore(store_dir, delta=True)
+            items = ''.join('- name: item{0}\n  enabled: true\n'.format(number) for number in range(40000))
+            versions = ['items:\n' + items, 'items:\n' + items.replace('item7\n', 'seven\n'),
+                        'items:\n' + items.replace('item39999\n', 'last\n')]
+            for version in versions:
+                with open(YeditTest.filename, 'w') as yfd:
+                    yfd.write(version)
+                store.add(YeditTest.filename)
+            self.assertGreater(len(versions[0]), 1 << 20)
+
+            backups = store.backups(YeditTest.filename)
+            self.assertTrue(all(entry['stored'] < 1024 for entry in backups[:-1]))
+            for position, version in enumerate(versions):
+                self.assertEqual(store.contents(YeditTest.filename, position), version)
+        finally:
+            shutil.rmtree(store_dir)
+
+    def test_run_ansible_backup_restore(self):
+        '''test restoring a backup through the module parameters'''
+        store_dir = tempfile.mkdtemp()
+        try:
+            with open(YeditTest.filename) as yfd:
+                original = yfd.read()
+            params = {'src': YeditTest.filename, 'backup': True, 'backup_ext': '', 'separator': '.',
+                      'state': 'present', 'edits': None, 'value': 'changed', 'value_type': '', 'key': 'a',
+                      'update': False, 'append': False, 'insert': False, 'content': None,
+                      'content_type': 'yaml', 'backup_store': store_dir}
+            self.assertTrue(Yedit.run_ansible(params)['changed'])
+
+            restore = dict(params, backup_restore=-1)
+            results = Yedit.run_ansible(restore)
+            self.assertTrue(results['changed'])
+            self.assertEqual(results['result']['hash'], Yedit.file_hash(YeditTest.filename))
+            with open(YeditTest.filename) as yfd:
+                self.assertEqual(yfd.read(), original)
+
+            self.assertFalse(Yedit.run_ansible(restore)['changed'])
+            self.assertTrue(Yedit.run_ansible(dict(restore, backup_restore=5))['failed'])
+
+            # restoring goes through the same lock, durability and conflict check as the edits
+            self.assertTrue(Yedit.run_ansible(params)['changed'])
+            checked = []
+            check = Yedit._check_unchanged
+
+            def recording_check(yed):
+                '''record that the file was checked before it was replaced'''
+                checked.append(yed.optimistic)
+                check(yed)
+
+            with mock.patch('yedit.Yedit._check_unchanged', recording_check):
+                results = Yedit.run_ansible(dict(restore, optimistic=True, lock=True, durability='none', debug=True))
+            self.assertTrue(results['changed'])
+            self.assertEqual(checked, [True])
+            self.assertEqual(results['debug']['durability'], 'none')
+            self.assertIn('lock_wait', results['debug'])
+            with open(YeditTest.filename) as yfd:
+                self.assertEqual(yfd.read(), original)
+            self.assertTrue(Yedit.run_ansible(dict(restore, backup_store=None))['failed'])
+        finally:
+            shutil.rmtree(store_dir)
+
+    def test_optimistic_conflict(self):
+        '''test that a file changed since it was read is not overwritten'''
+        yed = Yedit(YeditTest.filename, optimistic=True)
+        yed.put('a', 'mine')
+        other = Yedit(YeditTest.filename)
+        other.put('a', 'theirs')
+        other.write()
+        self.assertRaises(YeditConflict, yed.write)
+        self.assertEqual(Yedit(YeditTest.filename).get('a'), 'theirs')
+
+    @mock.patch('time.sleep')
+    def test_run_ansible_optimistic_retry(self, _):
+        '''test that run_ansible applies the edits again after a conflict'''
+        read = Yedit.read
+        raced = []
+
+        def racing_read(yed):
+            '''read the file and change it behind the reader once'''
+            contents = read(yed)
+            if not raced:
+                raced.append(True)
+                with open(YeditTest.filename, 'a') as yfd:
+                    yfd.write('other: 1\n')
+            return contents
+
+        params = {'src': YeditTest.filename, 'backup': False, 'backup_ext': '', 'separator': '.',
+                  'state': 'present', 'edits': None, 'value': 2, 'value_type': '', 'key': 'x',
+                  'update': False, 'append': False, 'insert': False, 'content': None,
+                  'content_type': 'yaml', 'optimistic': True, 'debug': True}
+        with mock.patch('yedit.Yedit.read', racing_read):
+            results = Yedit.run_ansible(params)
+        self.assertTrue(results['changed'])
+        self.assertEqual(results['debug']['conflicts'], 1)
+        yed = Yedit(YeditTest.filename)
+        self.assertEqual((yed.get('other'), yed.get('x')), (1, 2))
+
+    def test_run_ansible_optimistic_processes(self):
+        '''test that optimistic writers in parallel processes lose no update'''
+        params = {'src': YeditTest.filename, 'backup': False, 'backup_ext': '', 'separator': '.',
+                  'state': 'present', 'edits': None, 'value': 1, 'value_type': '', 'key': None,
+                  'update': False, 'append': False, 'insert': False, 'content': None,
+                  'content_type': 'yaml', 'optimistic': True, 'optimistic_retries': 1000,
+                  'durability': 'none'}
+
+        check = Yedit._check_unchanged
+
+        def slow_check(yed):
+            '''leave other writers time to get between the check and the replace'''
+            check(yed)
+            time.sleep(0.002)
+
+        def writer(number):
+            '''put keys of its own, one run at a time'''
+            with mock.patch('yedit.Yedit._check_unchanged', slow_check):
+                for key in range(10):
+                    if Yedit.run_ansible(dict(params, key='p{0}k{1}'.format(number, key))).get('failed'):
+                        os._exit(1)
+            os._exit(0)
+
+        pids = []
+        for number in range(8):
+            pid = os.fork()
+            if pid == 0:
+                writer(number)
+            pids.append(pid)
+        self.assertEqual([os.waitpid(pid, 0)[1] for pid in pids], [0] * 8)
+
+        keys = Yedit(YeditTest.filename).yaml_dict.keys()
+        self.assertEqual(len([key for key in keys if key.startswith('p')]), 80)
+
+    def test_run_ansible_fingerprint(self):
+        '''test that edits known to change nothing skip parsing the file'''
+        params = {'src': YeditTest.filename, 'backup': False, 'backup_ext': '', 'separator': '.',
+                  'state': 'present', 'edits': None, 'value': 'a', 'value_type': '', 'key': 'a',
+                  'update': False, 'append': False, 'insert': False, 'content': None,
+                  'content_type': 'yaml', 'fingerprint': True, 'debug': True}
+        no_xattr = (mock.patch('os.getxattr', side_effect=OSError, create=True),
+                    mock.patch('os.setxattr', side_effect=OSError, create=True))
+        try:
+            for patches in ((), no_xattr):
+                for patch in patches:
+                    patch.start()
+                try:
+                    self.setUp()
+                    self.assertEqual(Yedit.run_ansible(params)['debug']['fingerprint'], 'recorded')
+                    with mock.patch('yedit.Yedit.load') as mock_load:
+                        self.assertEqual(Yedit.run_ansible(params)['debug'], {'fingerprint': 'hit'})
+                        self.assertFalse(mock_load.called)
+
+                    with open(YeditTest.filename, 'a') as yfd:
+                        yfd.write('other: 1\n')
+                    self.assertNotIn('fingerprint', Yedit.run_ansible(dict(params, value='b'))['debug'])
+                finally:
+                    for patch in patches:
+                        patch.stop()
+        finally:
+            if os.path.exists(YeditTest.filename + '.yedit.fingerprint'):
+                os.unlink(YeditTest.filename + '.yedit.fingerprint')
+
+    def test_lock(self):
+        '''test that writers exclude each other and readers share the lock file'''
+        writer = Yedit(YeditTest.filename)
+        reader = Yedit(YeditTest.filename, read_only=True)
+        other_reader = Yedit(YeditTest.filename, read_only=True)
+        try:
+            writer.acquire_lock()
+            self.assertIn('lock_wait', writer.debug_info)
+            self.assertRaises(YeditException, reader.acquire_lock, shared=True, timeout=0.05)
+            writer.release_lock()
+
+            reader.acquire_lock(shared=True, timeout=0.05)
+            other_reader.acquire_lock(shared=True, timeout=0.05)
+            self.assertRaises(YeditException, writer.acquire_lock, timeout=0.05)
+        finally:
+            writer.release_lock()
+            reader.release_lock()
+            other_reader.release_lock()
+            os.unlink(YeditTest.filename + '.yedit.lock')
+
+    def test_append_in_place(self):
+        '''test that appending to the list at the end of a file only writes the new item'''
+        with open(YeditTest.filename, 'w') as yfd:
+            yfd.write('a: 1\nlist:\n  - a\n  - b: 1\n')
+        yed = Yedit(YeditTest.filename)
+        with mock.patch('yedit.Yedit._write') as mock_write:
+            self.assertTrue(yed.append_in_place('list', {'c': 2}))
+            self.assertFalse(mock_write.called)
+        with open(YeditTest.filename) as yfd:
+            self.assertEqual(yfd.read(), 'a: 1\nlist:\n  - a\n  - b: 1\n  - c: 2\n')
+        self.assertFalse(Yedit(YeditTest.filename).append_in_place('a', 2))
+
+        with open(YeditTest.filename, 'w') as yfd:
+            yfd.write('[\n    1\n]\n')
+        self.assertTrue(Yedit(YeditTest.filename, content_type='json').append_in_place('', {'b': 2}))
+        with open(YeditTest.filename) as yfd:
+            self.assertEqual(yfd.read(), '[\n    1,\n    {\n        "b": 2\n    }\n]\n')
+
+    def test_document(self):
+        '''test editing one document of a multi document file'''
+        source = '---\nkind: Service\nmetadata: {name: api}\n---\nkind: Deployment  # d\nmetadata:\n' + \
+                 '  name: api\n...\n---\nkind: Deployment\nmetadata: {name: web}\n'
+        with open(YeditTest.filename, 'w') as yfd:
+            yfd.write(source)
+        self.assertEqual(len(Yedit.split_documents(source)), 3)
+
+        yed = Yedit(YeditTest.filename, document='kind=Deployment,metadata.name=api')
+        yed.put('spec.replicas', 3)
+        yed.write()
+        with open(YeditTest.filename) as yfd:
+            self.assertEqual(yfd.read(), source.replace('  name: api\n', '  name: api\nspec:\n  replicas: 3\n'))
+
+        self.assertEqual(Yedit(YeditTest.filename, document=2).get('metadata.name'), 'web')
+        self.assertRaises(YeditException, Yedit(YeditTest.filename, document='kind=Deployment').load)
+        self.assertRaises(YeditException, Yedit(YeditTest.filename, document=3).load)
+
+    def test_document_markers(self):
+        '''test that the document markers survive a rewrite of the document'''
+        cases = [('---\r\na: 1\r\n---\r\nb: 2\r\n', 1, '---\r\na: 1\r\n---\r\nb: 2\r\nnew: 1\r\n'),
+                 ('--- {a: 1}\n--- {b: 2}\n', 1, '--- {a: 1}\n---\n{b: 2, new: 1}\n'),
+                 ('--- !t\na: 1\n---\nb: 2\n', 0, '---\n!t\na: 1\nnew: 1\n---\nb: 2\n'),
+                 ('%YAML 1.2\n---\na: 1\n...\n%YAML 1.2\n---\nb: 2\n', 1,
+                  '%YAML 1.2\n---\na: 1\n...\n%YAML 1.2\n---\nb: 2\nnew: 1\n')]
+        for source, document, expected in cases:
+            with open(YeditTest.filename, 'w', newline='') as yfd:
+                yfd.write(source)
+            self.assertEqual(len(Yedit.split_documents(source)), 2)
+
+            yed = Yedit(YeditTest.filename, document=document)
+            yed.put('new', 1)
+            yed.write()
+            with open(YeditTest.filename, newline='') as yfd:
+                self.assertEqual(yfd.read(), expected)
+
+    def test_stream_edits(self):
+        '''test that the stream engine writes what the in memory engine writes'''
+        source = '# head\na: 1  # keep\nb:\n  c: [1, 2]\n  d: x\ne:\n- y: 2\nn:\n'
+        edits = [{'key': 'a', 'value': 5},
+                 {'key': 'b.c', 'value': 3, 'action': 'append'},
+                 {'key': 'b.f.g', 'value': 'v'},
+                 {'key': 'e[0]', 'value': {'z': 1}, 'action': 'update'},
+                 {'key': 'e[1]', 'value': 'end'},
+                 {'key': 'n.x', 'value': 1}]
+        with open(YeditTest.filename, 'w') as yfd:
+            yfd.write(source)
+        yed = Yedit(content=source)
+        Yedit.process_edits(edits, yed)
+        yed.delete('b.d')
+        expected = yed.dumps()
+
+        changed, keys = Yedit(YeditTest.filename).stream_edits(edits + [{'key': 'b.d', 'action': 'delete'}])
+        self.assertTrue(changed)
+        self.assertEqual(keys, ['a', 'b.c', 'b.f.g', 'e[0]', 'e[1]', 'n.x', 'b.d'])
+        with open(YeditTest.filename) as yfd:
+            self.assertEqual(yfd.read(), expected)
+
+        self.assertEqual(Yedit(YeditTest.filename).stream_edits(edits[:1]), (False, []))
+        self.assertRaises(YeditException, Yedit(YeditTest.filename).stream_edits,
+                          [{'key': 'b.c', 'value': 1, 'action': 'insert', 'index': 0}])
+        self.assertFalse(os.path.exists(YeditTest.filename + '.yedit'))
+
+        # like in memory, update only changes a mapping that exists
+        cases = [('a: 1\nb: {c: 1}\nn:\n',
+                  [{'key': 'm', 'value': {'x': 1}, 'action': 'update'},
+                   {'key': 'a', 'value': {'x': 1}, 'action': 'update'},
+                   {'key': 'n', 'value': {'x': 1}, 'action': 'update'},
+                   {'key': 'b', 'value': {'d': 2}, 'action': 'update'}]),
+                 ('- a: 1\n- b\n',
+                  [{'key': 'm', 'value': {'x': 1}, 'action': 'update'},
+                   {'key': '[5]', 'value': {'x': 1}, 'action': 'update'},
+                   {'key': '[1]', 'value': {'x': 1}, 'action': 'update'},
+                   {'key': '[0]', 'value': {'c': 2}, 'action': 'update'}])]
+        for source, edits in cases:
+            with open(YeditTest.filename, 'w') as yfd:
+                yfd.write(source)
+            yed = Yedit(content=source)
+            results = Yedit.process_edits(edits, yed)
+            self.assertEqual(Yedit(YeditTest.filename).stream_edits(edits),
+                             (True, [result['key'] for result in results['results']]))
+            with open(YeditTest.filename) as yfd:
+                self.assertEqual(yfd.read(), yed.dumps())
+
+        # empty and explicitly tagged scalars are passed on as they are
+        source = 'q: ""\nr: \'\'\ns: [1, "", 2]\nt: !!str 12\nu: !!str\n'
+        with open(YeditTest.filename, 'w') as yfd:
+            yfd.write(source)
+        self.assertEqual(Yedit(YeditTest.filename).stream_edits([{'key': 'q', 'value': ''},
+                                                                 {'key': 't', 'value': '12', 'value_type': 'str'},
+                                                                 {'key': 'v', 'value': 1}]),
+                         (True, ['v']))
+        with open(YeditTest.filename) as yfd:
+            self.assertEqual(yfd.read(), source + 'v: 1\n')
+
     @mock.patch('yedit.Yedit.write')
     def test_run_ansible_basic(self, mock_write):
         '''test parse_value'''
@@ -375,3 +1149,6 @@ class YeditTest(unittest.TestCase):
     def tearDown(self):
         '''TearDown method'''
         os.unlink(YeditTest.filename)
+        # optimistic writes lock the file while replacing it
+        if os.path.exists(YeditTest.filename + '.yedit.lock'):
+            os.unlink(YeditTest.filename + '.yedit.lock')